@@ -54,7 +54,7 @@ function Dashboard() {
       
       // Build query based on filters
       let query = supabase
-        .from('vessel_positions')
+        .from('vessel_latest')
         .select(`
           *,
           vessel_metadata(vessel_name, vessel_type, flag, destination)
@@ -118,8 +118,8 @@ function Dashboard() {
     
     // Set up real-time subscription for vessel position updates
     const subscription = supabase
-      .from('vessel_positions')
-      .on('INSERT', payload => {
+      .from('vessel_latest')
+      .on('*', payload => {
         // Add the new vessel to our state if it passes filters
         // In a real app, you'd check filters here too
         setVessels(current => {
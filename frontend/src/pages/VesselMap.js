@@ -19,9 +19,10 @@ function VesselMap() {
     async function fetchGlobalVessels() {
       setLoading(true);
       
-      // Get the most recent positions for all vessels
+      // Get the most recent position for each vessel
+      // (vessel_latest holds one row per vessel, maintained by the collector)
       const { data, error } = await supabase
-        .from('vessel_positions')
+        .from('vessel_latest')
         .select(`
           *,
           vessel_metadata(vessel_name, vessel_type, flag, destination)
@@ -32,16 +33,7 @@ function VesselMap() {
       if (error) {
         console.error('Error fetching global vessels:', error);
       } else {
-        // Filter to get only the most recent position for each vessel
-        const uniqueVessels = {};
-        data.forEach(vessel => {
-          if (!uniqueVessels[vessel.mmsi] || 
-              new Date(vessel.timestamp) > new Date(uniqueVessels[vessel.mmsi].timestamp)) {
-            uniqueVessels[vessel.mmsi] = vessel;
-          }
-        });
-        
-        setVessels(Object.values(uniqueVessels));
+        setVessels(data || []);
       }
       
       setLoading(false);
@@ -49,10 +41,10 @@ function VesselMap() {
     
     fetchGlobalVessels();
     
-    // Set up real-time subscription for new vessel positions
+    // Set up real-time subscription for vessel position updates
     const subscription = supabase
-      .from('vessel_positions')
-      .on('INSERT', payload => {
+      .from('vessel_latest')
+      .on('*', payload => {
         setVessels(current => {
           // Update vessel if it exists, otherwise add it
           const existingIndex = current.findIndex(v => v.mmsi === payload.new.mmsi);
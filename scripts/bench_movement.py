@@ -0,0 +1,74 @@
+"""Benchmark batch vs per-vessel movement analysis.
+
+Usage: python scripts/bench_movement.py [vessels] [reports_per_vessel]
+
+Generates synthetic 24-hour tracks, checks that analyze_movement_batch gives
+the same results as analyze_movement_pattern for every vessel, and times both.
+"""
+import math
+import os
+import random
+import sys
+import time
+
+# predict_delays creates a Supabase client on import; no requests are made
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_KEY", "bench.bench.bench")
+
+from predict_delays import analyze_movement_batch, analyze_movement_pattern
+
+def make_histories(vessels, reports, rng):
+    """Build MMSI -> history rows with mixed moving, drifting and anchored tracks."""
+    histories = {}
+    for n in range(vessels):
+        mmsi = 200000000 + n
+        course = rng.uniform(0, 360)
+        speed = rng.choice([0.2, 2.0, 12.0])
+        rows = []
+        for i in range(rng.randint(1, reports)):
+            if rng.random() < 0.1:
+                speed = max(0.0, speed + rng.uniform(-3, 3))
+            course = (course + rng.gauss(0, 25)) % 360
+            rows.append({
+                "mmsi": mmsi,
+                "speed": None if rng.random() < 0.01 else round(speed, 1),
+                "course": round(course, 1),
+                "timestamp": f"2024-03-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}+00:00"
+            })
+        histories[mmsi] = rows
+    return histories
+
+def same(a, b):
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+        return True
+    return a == b
+
+def main():
+    vessels = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    reports = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    histories = make_histories(vessels, reports, random.Random(42))
+    total = sum(len(rows) for rows in histories.values())
+    print(f"{vessels} vessels, {total} reports")
+
+    start = time.perf_counter()
+    expected = {mmsi: analyze_movement_pattern(rows) for mmsi, rows in histories.items()}
+    per_vessel = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = analyze_movement_batch(histories)
+    batch = time.perf_counter() - start
+
+    mismatches = [
+        mmsi for mmsi in histories
+        if not all(same(expected[mmsi][key], actual[mmsi][key]) for key in expected[mmsi])
+    ]
+    print(f"per-vessel {per_vessel:8.2f} s")
+    print(f"batch      {batch:8.2f} s ({per_vessel / batch:.0f}x faster)")
+    print(f"mismatches {len(mismatches)}")
+    if mismatches:
+        mmsi = mismatches[0]
+        print(f"  {mmsi}: expected {expected[mmsi]}, got {actual[mmsi]}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
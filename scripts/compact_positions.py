@@ -0,0 +1,230 @@
+import argparse
+import os
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from supabase import create_client, Client
+
+# Supabase setup
+supabase_url = os.environ.get("SUPABASE_URL")
+supabase_key = os.environ.get("SUPABASE_KEY")
+supabase = create_client(supabase_url, supabase_key)
+
+# Raw vessel_positions rows are kept for RAW_RETENTION_HOURS (at least the 24
+# hours of history predict_delays.py reads). Older rows are compacted one
+# hour at a time, oldest first, into
+#   vessel_tracks:  one row per vessel per TRACK_INTERVAL_MINUTES (its first
+#                   report in that interval), keyed on (mmsi, bucket_start)
+#   traffic_hourly: per hour and TRAFFIC_HOURLY_CELL_DEG degree cell, the
+#                   number of distinct vessels, reports, average speed and
+#                   stationary vessels, keyed on (hour, cell_lat, cell_lon)
+# and then deleted in batches of DELETE_BATCH_SIZE ids. An hour is read with
+# keyset paging on (timestamp, id) and folded into the rollups page by page,
+# so only the rollups, never the raw rows, are held in memory. Rollups are
+# written before anything is deleted and never overwrite existing rows, so a
+# run interrupted mid-hour is completed by the next run without skewing the
+# aggregates. At most COMPACTION_MAX_HOURS hours are compacted per run.
+RAW_RETENTION_HOURS = max(24, int(os.environ.get("RAW_RETENTION_HOURS", "72")))
+TRACK_INTERVAL_MINUTES = int(os.environ.get("TRACK_INTERVAL_MINUTES", "15"))
+TRAFFIC_HOURLY_CELL_DEG = float(os.environ.get("TRAFFIC_HOURLY_CELL_DEG", "0.5"))
+COMPACTION_MAX_HOURS = int(os.environ.get("COMPACTION_MAX_HOURS", "48"))
+DELETE_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE", "500"))
+FETCH_PAGE_SIZE = 1000
+STATIONARY_SPEED = 1.0
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp as returned by PostgREST into an aware datetime."""
+    value = value.replace("Z", "+00:00")
+    # Older Pythons only accept 0, 3 or 6 fractional digits
+    value = re.sub(r"\.(\d+)", lambda m: "." + m.group(1)[:6].ljust(6, "0"), value, count=1)
+    timestamp = datetime.fromisoformat(value)
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+def oldest_position_before(cutoff, after=None):
+    """Return the timestamp of the oldest raw position before cutoff (and at or after `after`), or None."""
+    query = supabase.table("vessel_positions") \
+        .select("timestamp") \
+        .lt("timestamp", cutoff.isoformat())
+    if after is not None:
+        query = query.gte("timestamp", after.isoformat())
+    response = query \
+        .order("timestamp", desc=False) \
+        .limit(1) \
+        .execute()
+    return parse_timestamp(response.data[0]["timestamp"]) if response.data else None
+
+def iter_position_pages(start, end):
+    """Yield pages of raw positions with start <= timestamp < end, in (timestamp, id) order.
+    
+    Pages are fetched with keyset paging, so each query starts right after
+    the last row seen instead of skipping an ever larger offset.
+    """
+    last = None
+    while True:
+        query = supabase.table("vessel_positions") \
+            .select("id, mmsi, vessel_name, lat, lon, speed, course, timestamp") \
+            .gte("timestamp", start.isoformat()) \
+            .lt("timestamp", end.isoformat())
+        if last is not None:
+            query = query.or_(f'timestamp.gt."{last["timestamp"]}",'
+                              f'and(timestamp.eq."{last["timestamp"]}",id.gt.{last["id"]})')
+        response = query \
+            .order("timestamp", desc=False) \
+            .order("id", desc=False) \
+            .limit(FETCH_PAGE_SIZE) \
+            .execute()
+        if response.data:
+            yield response.data
+        if len(response.data) < FETCH_PAGE_SIZE:
+            return
+        last = response.data[-1]
+
+def downsample_tracks(positions, tracks, interval_minutes=TRACK_INTERVAL_MINUTES):
+    """Fold positions into tracks: each vessel's first report per interval, with the interval's report count."""
+    interval = interval_minutes * 60
+    for row in positions:
+        timestamp = parse_timestamp(row["timestamp"])
+        bucket = datetime.fromtimestamp(timestamp.timestamp() // interval * interval, timezone.utc)
+        key = (row.get("mmsi"), bucket)
+        if key in tracks:
+            tracks[key]["report_count"] += 1
+            continue
+        tracks[key] = {
+            "mmsi": row.get("mmsi"),
+            "vessel_name": row.get("vessel_name"),
+            "bucket_start": bucket.isoformat(),
+            "lat": row.get("lat"),
+            "lon": row.get("lon"),
+            "speed": row.get("speed"),
+            "course": row.get("course"),
+            "timestamp": row["timestamp"],
+            "report_count": 1
+        }
+    return tracks
+
+def new_traffic_cell():
+    return {"vessels": set(), "stationary": set(), "reports": 0, "speed_sum": 0.0, "speeds": 0}
+
+def aggregate_traffic(positions, cells, cell_deg=TRAFFIC_HOURLY_CELL_DEG):
+    """Fold positions into per grid cell traffic counts (a defaultdict of new_traffic_cell)."""
+    for row in positions:
+        lat, lon = row.get("lat"), row.get("lon")
+        if lat is None or lon is None:
+            continue
+        cell = cells[(lat // cell_deg * cell_deg, lon // cell_deg * cell_deg)]
+        cell["vessels"].add(row.get("mmsi"))
+        cell["reports"] += 1
+        speed = row.get("speed")
+        if speed is not None:
+            cell["speed_sum"] += speed
+            cell["speeds"] += 1
+            if speed < STATIONARY_SPEED:
+                cell["stationary"].add(row.get("mmsi"))
+    return cells
+
+def traffic_rows(cells, hour):
+    """Return the traffic_hourly rows of an hour's aggregated cells."""
+    return [
+        {
+            "hour": hour.isoformat(),
+            "hour_of_day": hour.hour,
+            "cell_lat": round(cell_lat, 6),
+            "cell_lon": round(cell_lon, 6),
+            "vessel_count": len(cell["vessels"]),
+            "report_count": cell["reports"],
+            "avg_speed": round(cell["speed_sum"] / cell["speeds"], 2) if cell["speeds"] else None,
+            "stationary_vessels": len(cell["stationary"])
+        }
+        for (cell_lat, cell_lon), cell in cells.items()
+    ]
+
+def insert_rollups(table, rows, on_conflict):
+    """Insert rollup rows, leaving rows that already exist untouched."""
+    for i in range(0, len(rows), FETCH_PAGE_SIZE):
+        supabase.table(table) \
+            .upsert(rows[i:i + FETCH_PAGE_SIZE], on_conflict=on_conflict, ignore_duplicates=True) \
+            .execute()
+
+def delete_positions(start, end):
+    """Delete the raw positions with start <= timestamp < end, DELETE_BATCH_SIZE rows at a time."""
+    while True:
+        response = supabase.table("vessel_positions") \
+            .select("id") \
+            .gte("timestamp", start.isoformat()) \
+            .lt("timestamp", end.isoformat()) \
+            .order("id", desc=False) \
+            .limit(DELETE_BATCH_SIZE) \
+            .execute()
+        if not response.data:
+            return
+        supabase.table("vessel_positions") \
+            .delete() \
+            .in_("id", [row["id"] for row in response.data]) \
+            .execute()
+        if len(response.data) < DELETE_BATCH_SIZE:
+            return
+
+def compact_hour(hour, dry_run=False):
+    """Roll up and delete the raw positions of one hour.
+    
+    Returns (positions, track points, traffic cells).
+    """
+    end = hour + timedelta(hours=1)
+    positions = 0
+    tracks = {}
+    cells = defaultdict(new_traffic_cell)
+    for page in iter_position_pages(hour, end):
+        positions += len(page)
+        downsample_tracks(page, tracks)
+        aggregate_traffic(page, cells)
+    
+    if not dry_run:
+        insert_rollups("vessel_tracks", list(tracks.values()), "mmsi,bucket_start")
+        insert_rollups("traffic_hourly", traffic_rows(cells, hour), "hour,cell_lat,cell_lon")
+        delete_positions(hour, end)
+    
+    return positions, len(tracks), len(cells)
+
+def main(max_hours=COMPACTION_MAX_HOURS, dry_run=False):
+    """Compact raw positions older than the retention window."""
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(hours=RAW_RETENTION_HOURS)).replace(minute=0, second=0, microsecond=0)
+    print(f"Compacting vessel positions before {cutoff.isoformat()}{' (dry run)' if dry_run else ''}")
+    
+    totals = [0, 0, 0]
+    hours = 0
+    after = None
+    while hours < max_hours:
+        try:
+            # A dry run deletes nothing, so it has to move past the hours it has seen
+            oldest = oldest_position_before(cutoff, after if dry_run else None)
+        except Exception as e:
+            print(f"Error finding positions to compact: {e}")
+            break
+        if oldest is None:
+            break
+    
+        hour = oldest.replace(minute=0, second=0, microsecond=0)
+        try:
+            counts = compact_hour(hour, dry_run)
+        except Exception as e:
+            print(f"Error compacting {hour.isoformat()}: {e}")
+            break
+    
+        print(f"{hour.isoformat()}: {counts[0]} positions -> {counts[1]} track points, {counts[2]} traffic cells")
+        totals = [total + count for total, count in zip(totals, counts)]
+        hours += 1
+        after = hour + timedelta(hours=1)
+    
+    if not hours:
+        print("Nothing to compact.")
+        return
+    
+    print(f"Compacted {hours} hours: {totals[0]} positions -> {totals[1]} track points, {totals[2]} traffic cells")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll up and delete vessel positions older than the retention window.")
+    parser.add_argument("--max-hours", type=int, default=COMPACTION_MAX_HOURS, help="maximum number of hours to compact in this run")
+    parser.add_argument("--dry-run", action="store_true", help="compute rollups without writing or deleting anything")
+    args = parser.parse_args()
+    main(max_hours=args.max_hours, dry_run=args.dry_run)
@@ -0,0 +1,103 @@
+"""Rate-limited, retrying client for the Hugging Face Inference API.
+
+Shared by the scripts in this directory. Calls go through one pooled
+requests session and are spaced by a RateLimiter shared across threads.
+Timeouts, 429 and 5xx responses are retried, waiting for the server's
+Retry-After (or a loading model's estimated_time) when given and a jittered
+exponential backoff otherwise.
+"""
+import random
+import threading
+import time
+from contextlib import nullcontext
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls at most `rate` per second apart."""
+    
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        """Block until the caller may make its next call."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def retry_delay(response, attempt, backoff_base=1, backoff_max=60):
+    """Seconds to wait before retrying, preferring the server's own hint."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(backoff_max, float(retry_after))
+            except ValueError:
+                pass
+        if response.status_code == 503:
+            # The model is loading; the API says roughly how long it will take
+            try:
+                return min(backoff_max, float(response.json()["estimated_time"]))
+            except Exception:
+                pass
+    
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+class HFClient:
+    """Text generation calls against one model, shared by a pool of threads."""
+    
+    def __init__(self, api_url, api_token, workers=8, requests_per_second=2, timeout=60,
+                 max_retries=4, backoff_base=1, backoff_max=60):
+        self.api_url = api_url
+        self.headers = {
+            "Authorization": f"Bearer {api_token}",
+            "Content-Type": "application/json"
+        }
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers)))
+    
+    def generate(self, prompt, parameters, timer=None):
+        """Return the generated text for a prompt, or None if the call failed.
+    
+        timer, if given, is called with "llm_wait" and "llm_request" and must
+        return a context manager timing the rate-limit wait and the request.
+        """
+        timer = timer or (lambda stage: nullcontext())
+        data = {"inputs": prompt, "parameters": parameters}
+        attempts = self.max_retries + 1
+    
+        for attempt in range(attempts):
+            with timer("llm_wait"):
+                self.rate_limiter.wait()
+            response = None
+            try:
+                with timer("llm_request"):
+                    response = self.session.post(self.api_url, headers=self.headers, json=data, timeout=self.timeout)
+    
+                if response.status_code == 200:
+                    return response.json()[0]["generated_text"]
+                elif response.status_code != 429 and response.status_code < 500:
+                    print(f"Error querying Hugging Face API: {response.text}")
+                    return None
+                print(f"Hugging Face API returned {response.status_code} (attempt {attempt + 1}/{attempts})")
+            except requests.RequestException as e:
+                print(f"Exception in Hugging Face API call (attempt {attempt + 1}/{attempts}): {e}")
+            except Exception as e:
+                print(f"Exception in Hugging Face API call: {e}")
+                return None
+    
+            if attempt < self.max_retries:
+                time.sleep(retry_delay(response, attempt, self.backoff_base, self.backoff_max))
+    
+        return None
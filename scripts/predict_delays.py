@@ -1,8 +1,19 @@
+import argparse
+import cProfile
 import os
-import requests
 import json
+import math
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from supabase import create_client, Client
-from datetime import datetime, timedelta
+from hf_client import HFClient
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import numpy as np
 import pandas as pd
 
 # Supabase setup
@@ -14,57 +25,406 @@ supabase = create_client(supabase_url, supabase_key)
 HF_API_TOKEN = os.environ.get("HF_API_TOKEN")
 HF_API_URL = "https://api-inference.huggingface.co/models/mistralai/Mixtral-8x7B-v0.1"
 
-def get_pending_prediction_requests():
-    """Get all vessels in the prediction queue with 'pending' status."""
+# Jobs are claimed from prediction_queue in batches of CLAIM_BATCH_SIZE by
+# setting status "processing", worker_id and lease_expires_at (columns this
+# mode relies on). A job whose lease expires without completing, e.g. because
+# its worker died or its prediction failed, becomes claimable again, so any
+# number of workers can run side by side without processing a job twice.
+CLAIM_BATCH_SIZE = int(os.environ.get("CLAIM_BATCH_SIZE", "200"))
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", "900"))
+WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", "10"))
+# A long-running worker reports (and resets) its stage timings every
+# TIMINGS_REPORT_BATCHES batches
+TIMINGS_REPORT_BATCHES = int(os.environ.get("TIMINGS_REPORT_BATCHES", "20"))
+
+# Inference runs on HF_WORKERS threads sharing one pooled session, limited to
+# HF_REQUESTS_PER_SECOND. Failed calls (timeouts, 429, 5xx) are retried up to
+# HF_MAX_RETRIES times, waiting for the server's Retry-After/estimated_time
+# when given and a jittered exponential backoff otherwise.
+HF_WORKERS = int(os.environ.get("HF_WORKERS", "8"))
+HF_REQUESTS_PER_SECOND = float(os.environ.get("HF_REQUESTS_PER_SECOND", "2"))
+HF_TIMEOUT = float(os.environ.get("HF_TIMEOUT", "60"))
+HF_MAX_RETRIES = int(os.environ.get("HF_MAX_RETRIES", "4"))
+HF_BACKOFF_BASE = float(os.environ.get("HF_BACKOFF_BASE", "1"))
+HF_BACKOFF_MAX = float(os.environ.get("HF_BACKOFF_MAX", "60"))
+
+hf_client = HFClient(HF_API_URL, HF_API_TOKEN, HF_WORKERS, HF_REQUESTS_PER_SECOND, HF_TIMEOUT,
+                     HF_MAX_RETRIES, HF_BACKOFF_BASE, HF_BACKOFF_MAX)
+
+# Predictions are cached on quantized features in PREDICTION_CACHE_FILE so
+# vessels in near-identical situations reuse an earlier answer, within this
+# run and across runs. Entries expire after PREDICTION_CACHE_TTL seconds and
+# the oldest are evicted beyond PREDICTION_CACHE_SIZE entries.
+PREDICTION_CACHE_FILE = os.environ.get("PREDICTION_CACHE_FILE", ".cache/prediction_cache.json")
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", "3600"))
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "5000"))
+PREDICTION_CACHE_CELL_DEG = float(os.environ.get("PREDICTION_CACHE_CELL_DEG", "0.1"))
+
+# Clear-cut cases are answered by a local rule-based estimator; only estimates
+# below LOCAL_CONFIDENCE_THRESHOLD are escalated to the AI model. Set it above
+# 1 to send everything to the model.
+LOCAL_CONFIDENCE_THRESHOLD = float(os.environ.get("LOCAL_CONFIDENCE_THRESHOLD", "0.8"))
+
+# Movement statistics are read from vessel_stats, which the AIS collector
+# keeps up to date as reports arrive. Rows older than
+# VESSEL_STATS_MAX_AGE_MINUTES are ignored, as are rows resting on less than
+# VESSEL_STATS_MIN_WEIGHT (decayed) reports: the collector rebuilds its
+# statistics from scratch when it restarts or a vessel changes shards. Only
+# vessels without usable statistics have their position history fetched and
+# analyzed.
+VESSEL_STATS_MAX_AGE_MINUTES = float(os.environ.get("VESSEL_STATS_MAX_AGE_MINUTES", "60"))
+VESSEL_STATS_MIN_WEIGHT = float(os.environ.get("VESSEL_STATS_MIN_WEIGHT", "10"))
+
+class StageTimings:
+    """Thread-safe wall-time samples per pipeline stage.
+    
+    Stages can nest and run concurrently (e.g. every inference call is timed
+    from its worker thread), so stage totals are not meant to add up to the
+    run time.
+    """
+    
+    def __init__(self):
+        self.samples = defaultdict(list)  # stage -> [seconds, ...]
+        self.lock = threading.Lock()
+    
+    @contextmanager
+    def time(self, stage):
+        """Context manager recording the wall time of its block under `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.samples[stage].append(elapsed)
+    
+    def reset(self):
+        """Discard all samples."""
+        with self.lock:
+            self.samples = defaultdict(list)
+    
+    def summary(self):
+        """Return stage -> calls, total, mean, p50, p95 and max in seconds."""
+        def percentile(values, p):
+            return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+        
+        with self.lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+        return {
+            stage: {
+                "calls": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max": values[-1]
+            }
+            for stage, values in samples.items()
+        }
+    
+    def report(self):
+        """Print the summary as a table, slowest stage first."""
+        summary = self.summary()
+        if not summary:
+            return
+        print(f"{'Stage':<16}{'Calls':>7}{'Total s':>10}{'Mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'Max ms':>10}")
+        for stage, stats in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+            print(f"{stage:<16}{stats['calls']:>7}{stats['total']:>10.2f}{stats['mean'] * 1000:>10.1f}"
+                  f"{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['max'] * 1000:>10.1f}")
+    
+    def write_json(self, path):
+        """Write the summary to a JSON file."""
+        try:
+            with open(path, "w") as f:
+                json.dump(self.summary(), f, indent=2)
+        except OSError as e:
+            print(f"Error writing stage timings: {e}")
+
+stage_timings = StageTimings()
+
+class PredictionCache:
+    """File-backed cache of parsed predictions with TTL and size-bound eviction."""
+    
+    def __init__(self, path, ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = {}  # key -> {"prediction": ..., "created": epoch seconds}
+        self.hits = 0
+        self.misses = 0
+    
+    def load(self):
+        """Load unexpired entries from the cache file, if there is one."""
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        self.entries = {
+            key: entry for key, entry in entries.items()
+            if now - entry.get("created", 0) < self.ttl
+        }
+    
+    def save(self):
+        """Write the cache back to its file."""
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.entries, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            print(f"Error saving prediction cache: {e}")
+    
+    def get(self, key):
+        """Return the cached prediction for a key, or None."""
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry["created"] >= self.ttl:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["prediction"]
+    
+    def put(self, key, prediction):
+        """Store a prediction, evicting the oldest entries beyond max_size."""
+        self.entries.pop(key, None)
+        self.entries[key] = {"prediction": prediction, "created": time.time()}
+        while len(self.entries) > self.max_size:
+            del self.entries[next(iter(self.entries))]
+    
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+# Vessel histories are fetched for HISTORY_CHUNK_SIZE vessels per query, and
+# each query is paged HISTORY_PAGE_SIZE rows at a time (PostgREST caps the
+# number of rows a single request returns)
+HISTORY_CHUNK_SIZE = int(os.environ.get("HISTORY_CHUNK_SIZE", "50"))
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "1000"))
+
+# Vessels seen in the last TRAFFIC_WINDOW_MINUTES are loaded once per run into
+# a grid of TRAFFIC_CELL_DEG degree cells and answer every vicinity lookup
+TRAFFIC_WINDOW_MINUTES = int(os.environ.get("TRAFFIC_WINDOW_MINUTES", "30"))
+TRAFFIC_CELL_DEG = float(os.environ.get("TRAFFIC_CELL_DEG", "0.5"))
+EARTH_RADIUS_NM = 3440.065
+
+# Typical traffic comes from the hourly per-cell aggregates compact_positions.py
+# rolls old positions up into: the mean number of vessels seen in a vessel's
+# TRAFFIC_HOURLY_CELL_DEG cell at the current hour of day over the last
+# TRAFFIC_BASELINE_DAYS days
+TRAFFIC_HOURLY_CELL_DEG = float(os.environ.get("TRAFFIC_HOURLY_CELL_DEG", "0.5"))
+TRAFFIC_BASELINE_DAYS = int(os.environ.get("TRAFFIC_BASELINE_DAYS", "28"))
+
+def claim_prediction_jobs(worker_id, limit=CLAIM_BATCH_SIZE):
+    """Lease up to `limit` pending (or lease-expired) jobs for this worker."""
+    now = datetime.now(timezone.utc)
+    claimable = f"status.eq.pending,and(status.eq.processing,lease_expires_at.lt.{now.isoformat().replace('+00:00', 'Z')})"
     try:
+        candidates = supabase.table("prediction_queue") \
+            .select("id") \
+            .or_(claimable) \
+            .order("created_at", desc=False) \
+            .limit(limit) \
+            .execute()
+        
+        ids = [row["id"] for row in candidates.data]
+        if not ids:
+            return []
+        
+        # The update re-checks the claimable condition row by row, so when
+        # workers race for the same jobs each job goes to exactly one of them
         response = supabase.table("prediction_queue") \
-            .select("*") \
-            .eq("status", "pending") \
+            .update({
+                "status": "processing",
+                "worker_id": worker_id,
+                "lease_expires_at": (now + timedelta(seconds=LEASE_SECONDS)).isoformat()
+            }) \
+            .in_("id", ids) \
+            .or_(claimable) \
             .execute()
         
         return response.data
     except Exception as e:
-        print(f"Error getting pending predictions: {e}")
+        print(f"Error claiming predictions: {e}")
         return []
 
 def get_vessel_history(mmsi, vessel_name, hours=24):
     """Get historical position data for a specific vessel."""
-    try:
-        # Calculate time threshold
-        time_threshold = (datetime.now(datetime.timezone.utc) - timedelta(hours=hours)).isoformat()
-        
-        # Query vessel positions
-        response = supabase.table("vessel_positions") \
-            .select("*") \
-            .eq("mmsi", mmsi) \
-            .gte("timestamp", time_threshold) \
-            .order("timestamp", desc=False) \
-            .execute()
-        
-        return response.data
-    except Exception as e:
-        print(f"Error getting vessel history for {vessel_name or mmsi}: {e}")
-        return []
+    return get_vessel_histories([mmsi], hours).get(mmsi, [])
 
-def format_data_for_prediction(vessel_data, history):
-    """Prepare the data for the AI model to predict delays."""
-    if not history:
-        return None
+def get_vessel_histories(mmsis, hours=24):
+    """Get historical position data for many vessels, grouped by MMSI."""
+    histories = defaultdict(list)
+    mmsis = list(dict.fromkeys(m for m in mmsis if m is not None))
+    
+    # Calculate time threshold
+    time_threshold = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
     
-    # Parse the position data if it's stored as a string
+    for i in range(0, len(mmsis), HISTORY_CHUNK_SIZE):
+        chunk = mmsis[i:i + HISTORY_CHUNK_SIZE]
+        offset = 0
+        try:
+            while True:
+                # Query vessel positions for the whole chunk, one page at a time
+                with stage_timings.time("history_query"):
+                    response = supabase.table("vessel_positions") \
+                        .select("*") \
+                        .in_("mmsi", chunk) \
+                        .gte("timestamp", time_threshold) \
+                        .order("timestamp", desc=False) \
+                        .order("id", desc=False) \
+                        .range(offset, offset + HISTORY_PAGE_SIZE - 1) \
+                        .execute()
+                
+                for row in response.data:
+                    histories[row.get("mmsi")].append(row)
+                
+                if len(response.data) < HISTORY_PAGE_SIZE:
+                    break
+                offset += HISTORY_PAGE_SIZE
+        except Exception as e:
+            print(f"Error getting vessel history for {len(chunk)} vessels: {e}")
+    
+    return histories
+
+def get_vessel_stats(mmsis):
+    """Get fresh, well-founded movement statistics from vessel_stats, keyed by MMSI.
+    
+    Each value has the keys analyze_movement_pattern returns.
+    """
+    stats = {}
+    mmsis = list(dict.fromkeys(m for m in mmsis if m is not None))
+    
+    time_threshold = (datetime.now(timezone.utc) - timedelta(minutes=VESSEL_STATS_MAX_AGE_MINUTES)).isoformat()
+    
+    for i in range(0, len(mmsis), HISTORY_CHUNK_SIZE):
+        chunk = mmsis[i:i + HISTORY_CHUNK_SIZE]
+        try:
+            response = supabase.table("vessel_stats") \
+                .select("mmsi, avg_speed, speed_variation, course_changes, stationary_periods") \
+                .in_("mmsi", chunk) \
+                .gte("updated_at", time_threshold) \
+                .gte("report_weight", VESSEL_STATS_MIN_WEIGHT) \
+                .execute()
+            
+            for row in response.data:
+                stats[row["mmsi"]] = {
+                    "avg_speed": row.get("avg_speed") if row.get("avg_speed") is not None else "Unknown",
+                    "speed_variation": row.get("speed_variation") if row.get("speed_variation") is not None else "Unknown",
+                    "course_changes": row.get("course_changes"),
+                    "stationary_periods": row.get("stationary_periods")
+                }
+        except Exception as e:
+            print(f"Error getting vessel stats for {len(chunk)} vessels: {e}")
+    
+    return stats
+
+def parse_position_data(vessel_data):
+    """Return a queue job's position data, parsing it if it's stored as a string."""
     if isinstance(vessel_data.get("position_data"), str):
         try:
-            position_data = json.loads(vessel_data["position_data"])
+            return json.loads(vessel_data["position_data"])
         except:
-            position_data = {}
-    else:
-        position_data = vessel_data.get("position_data", {})
+            return {}
+    return vessel_data.get("position_data") or {}
+
+def collect_prediction_features(vessel_data, history, traffic_index=None, movement_data=None):
+    """Gather the position, movement and traffic data a prediction is based on."""
+    if not history and movement_data is None:
+        return None
+    
+    position_data = parse_position_data(vessel_data)
     
     # Calculate average speed, course changes, etc.
-    movement_data = analyze_movement_pattern(history)
+    if movement_data is None:
+        movement_data = analyze_movement_pattern(history)
     
     # Get historical traffic data if available
-    traffic_data = get_traffic_data(position_data.get("lat"), position_data.get("lon"))
+    traffic_data = get_traffic_data(position_data.get("lat"), position_data.get("lon"), traffic_index=traffic_index)
+    
+    return {
+        "position": position_data,
+        "movement": movement_data,
+        "traffic": traffic_data
+    }
+
+def prediction_cache_key(features):
+    """Quantize prediction features into a cache key."""
+    def bucket(value, step):
+        if isinstance(value, (int, float)) and not math.isnan(value):
+            return round(value / step) * step
+        return str(value)
+    
+    position = features["position"]
+    movement = features["movement"]
+    return json.dumps([
+        bucket(position.get("lat"), PREDICTION_CACHE_CELL_DEG),
+        bucket(position.get("lon"), PREDICTION_CACHE_CELL_DEG),
+        bucket(position.get("speed"), 1),
+        bucket(movement.get("avg_speed"), 1),
+        bucket(movement.get("speed_variation"), 1),
+        bucket(movement.get("course_changes"), 5),
+        bucket(movement.get("stationary_periods"), 2),
+        features["traffic"].get("congestion_level")
+    ])
+
+def estimate_delay_locally(features):
+    """Estimate a delay from movement and traffic features without the AI model.
+    
+    Returns a prediction shaped like the model's JSON answer; its confidence
+    decides whether the estimate is used or the vessel is escalated.
+    """
+    def number(value):
+        if isinstance(value, (int, float)) and not math.isnan(value):
+            return value
+        return None
+    
+    speed = number(features["position"].get("speed"))
+    avg_speed = number(features["movement"].get("avg_speed"))
+    course_changes = number(features["movement"].get("course_changes"))
+    nearby_vessels = number(features["traffic"].get("nearby_vessels"))
+    congestion = features["traffic"].get("congestion_level")
+    
+    if speed is None or avg_speed is None or nearby_vessels is None:
+        return {"confidence": 0.0}
+    
+    # Held at anchor in a congested area: queueing for a berth, with the wait
+    # growing with the number of vessels around it
+    if speed < 0.5 and avg_speed < 1.0 and congestion == "High":
+        return {
+            "delay_minutes": int(min(720, 120 + 10 * nearby_vessels)),
+            "confidence": 0.85,
+            "causes": f"Vessel stationary in a high-congestion area with {nearby_vessels} vessels nearby (local estimate)",
+            "rerouting_suggestion": "Consider an alternative berth or port if one is available"
+        }
+    
+    # Steaming steadily through open water
+    if speed >= 8.0 and avg_speed >= 8.0 and congestion == "Low" and (course_changes or 0) <= 5:
+        return {
+            "delay_minutes": 0,
+            "confidence": 0.85,
+            "causes": "Vessel underway at normal speed in low traffic (local estimate)",
+            "rerouting_suggestion": "None"
+        }
+    
+    return {"confidence": 0.3}
+
+def format_data_for_prediction(vessel_data, history, traffic_index=None, movement_data=None):
+    """Prepare the data for the AI model to predict delays."""
+    if traffic_index is None:
+        traffic_index = load_traffic_index()
+    features = collect_prediction_features(vessel_data, history, traffic_index, movement_data)
+    if features is None:
+        return None
+    
+    return build_prediction_prompt(vessel_data, features)
+
+def build_prediction_prompt(vessel_data, features):
+    """Format the prediction prompt from collected features."""
+    position_data = features["position"]
+    movement_data = features["movement"]
+    traffic_data = features["traffic"]
     
     # Format prompt for AI
     prompt = f"""
@@ -89,6 +449,7 @@ def format_data_for_prediction(vessel_data, history):
     Traffic Information:
     Vessels in vicinity: {traffic_data.get('nearby_vessels')}
     Port congestion level: {traffic_data.get('congestion_level')}
+    Typical vessels in area at this hour: {traffic_data.get('typical_vessels')}
     
     Based on this data:
     1. Is the vessel likely to be delayed? If so, by how many minutes?
@@ -156,88 +517,239 @@ def analyze_movement_pattern(history):
             "stationary_periods": "Error"
         }
 
-def get_traffic_data(lat, lon, radius_nm=20):
-    """Get information about other vessels in the vicinity."""
-    if not lat or not lon:
-        return {
-            "nearby_vessels": "Unknown",
-            "congestion_level": "Unknown"
-        }
+def _segment_sums(values, starts, lengths):
+    """Sum consecutive segments of an array, one segment per vessel.
+    
+    Segments of equal length are summed together as rows of a 2-D array, which
+    uses the same pairwise summation as summing each segment on its own.
+    """
+    sums = np.empty(len(lengths))
+    for length in np.unique(lengths):
+        which = np.flatnonzero(lengths == length)
+        sums[which] = values[starts[which, None] + np.arange(length)].sum(axis=1)
+    return sums
+
+def analyze_movement_batch(histories):
+    """Analyze the movement patterns of many vessels in one vectorized pass.
+    
+    Takes MMSI -> history rows (as returned by get_vessel_histories) and returns
+    MMSI -> the same result analyze_movement_pattern gives for that history.
+    Vessels without history are left out.
+    """
+    histories = {mmsi: history for mmsi, history in histories.items() if history}
+    if not histories:
+        return {}
     
     try:
-        # Get current time
-        now = datetime.now(datetime.timezone.utc)
-        time_threshold = (now - timedelta(minutes=30)).isoformat()
+        mmsis = list(histories)
+        lengths = [len(histories[mmsi]) for mmsi in mmsis]
+        rows = [row for mmsi in mmsis for row in histories[mmsi]]
+        vessel = np.repeat(np.arange(len(mmsis)), lengths)
+        has_speed = any("speed" in row for row in rows)
+        has_course = any("course" in row for row in rows)
         
-        # Convert radius from nautical miles to approximate degrees
-        # 1 nautical mile ≈ 0.01666 degrees at the equator
-        radius_deg = radius_nm * 0.01666
+        speed = np.array([row.get("speed") for row in rows], dtype=float)
+        course = np.array([row.get("course") for row in rows], dtype=float)
         
-        # Query for vessels in the area
-        response = supabase.table("vessel_positions") \
-            .select("mmsi", "vessel_name") \
-            .gte("timestamp", time_threshold) \
-            .lt("lat", lat + radius_deg) \
-            .gt("lat", lat - radius_deg) \
-            .lt("lon", lon + radius_deg) \
-            .gt("lon", lon - radius_deg) \
-            .execute()
-        
-        vessels = response.data
-        
-        # Count unique vessels
-        unique_vessels = set()
-        for vessel in vessels:
-            unique_vessels.add(vessel.get("mmsi"))
+        # Mean and sample standard deviation of speed per vessel, computed the
+        # way pandas does (two-pass, missing values as zero) so the rounded
+        # values match analyze_movement_pattern exactly
+        lengths = np.array(lengths)
+        starts = np.r_[0, np.cumsum(lengths)[:-1]]
+        missing = np.isnan(speed)
+        filled = np.where(missing, 0.0, speed)
+        counts = np.bincount(vessel, weights=~missing, minlength=len(mmsis))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg_speed = _segment_sums(filled, starts, lengths) / counts
+            squares = (avg_speed[vessel] - filled) ** 2
+            squares[missing] = 0.0
+            speed_variation = np.sqrt(_segment_sums(squares, starts, lengths) / np.where(counts > 1, counts - 1, np.nan))
         
-        vessel_count = len(unique_vessels)
+        # Significant course changes (> 30 degrees) between consecutive reports,
+        # ignoring jumps across the 0/360 boundary
+        first = np.r_[True, vessel[1:] != vessel[:-1]]
+        diff = np.abs(course - np.r_[np.nan, course[:-1]])
+        diff[first] = np.nan
+        course_changes = np.bincount(vessel, weights=(diff > 30) & (diff < 330), minlength=len(mmsis))
         
-        # Determine congestion level
-        if vessel_count < 5:
-            congestion = "Low"
-        elif vessel_count < 15:
-            congestion = "Medium"
+        # Stationary periods (speed < 1 knot): a report with an unknown speed
+        # keeps the vessel in its current state, so forward-fill the state
+        state = pd.Series(np.where(speed < 1.0, 1.0, np.where(speed >= 1.0, 0.0, np.nan)))
+        state = state.groupby(vessel).ffill().fillna(0.0).to_numpy()
+        previous_state = np.r_[0.0, state[:-1]]
+        previous_state[first] = 0.0
+        stationary_periods = np.bincount(vessel, weights=(state == 1.0) & (previous_state == 0.0), minlength=len(mmsis))
+    except Exception as e:
+        print(f"Error analyzing movement patterns: {e}")
+        return {}
+    
+    results = {}
+    for i, mmsi in enumerate(mmsis):
+        results[mmsi] = {
+            "avg_speed": round(avg_speed[i], 2) if has_speed else "Unknown",
+            "speed_variation": round(speed_variation[i], 2) if has_speed else "Unknown",
+            "course_changes": int(course_changes[i]) if has_course else 0,
+            "stationary_periods": int(stationary_periods[i]) if has_speed else 0
+        }
+    return results
+
+def haversine_nm(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in nautical miles."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_NM * math.asin(math.sqrt(min(1.0, a)))
+
+class TrafficIndex:
+    """Grid of recent vessel positions for nearby-vessel counts."""
+    
+    def __init__(self, positions, cell_deg=TRAFFIC_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.lon_cells = math.ceil(360 / cell_deg)
+        self.cells = defaultdict(list)
+        self.baselines = {}  # traffic_hourly cell -> typical vessel count
+        for row in positions:
+            lat, lon = row.get("lat"), row.get("lon")
+            if lat is None or lon is None:
+                continue
+            self.cells[self._cell(lat, lon)].append((lat, lon, row.get("mmsi")))
+    
+    def _cell(self, lat, lon):
+        return (math.floor((lat + 90) / self.cell_deg), math.floor((lon + 180) / self.cell_deg) % self.lon_cells)
+    
+    def count_nearby(self, lat, lon, radius_nm):
+        """Count unique vessels within radius_nm nautical miles of a point."""
+        # Latitude degrees are a fixed 60 nm; longitude degrees shrink with cos(lat)
+        lat_span = radius_nm / 60
+        if abs(lat) + lat_span >= 90:
+            # The circle reaches over the pole, so it can touch every longitude
+            lon_span = 180
         else:
-            congestion = "High"
+            lon_span = min(180, lat_span / math.cos(math.radians(abs(lat) + lat_span)))
+        
+        row_min, col_min = self._cell(max(-90, lat - lat_span), lon - lon_span)
+        row_max = self._cell(min(90, lat + lat_span), lon)[0]
+        col_count = min(self.lon_cells, math.ceil(2 * lon_span / self.cell_deg) + 2)
         
+        nearby = set()
+        for cell_row in range(row_min, row_max + 1):
+            for i in range(col_count):
+                for other_lat, other_lon, mmsi in self.cells.get((cell_row, (col_min + i) % self.lon_cells), ()):
+                    if mmsi not in nearby and haversine_nm(lat, lon, other_lat, other_lon) <= radius_nm:
+                        nearby.add(mmsi)
+        return len(nearby)
+    
+    def typical_vessels(self, lat, lon):
+        """Typical vessel count of the point's traffic_hourly cell, or None."""
+        return self.baselines.get(traffic_hourly_cell(lat, lon))
+
+def traffic_hourly_cell(lat, lon):
+    """The (cell_lat, cell_lon) key of a point in traffic_hourly."""
+    return (round(lat // TRAFFIC_HOURLY_CELL_DEG * TRAFFIC_HOURLY_CELL_DEG, 6),
+            round(lon // TRAFFIC_HOURLY_CELL_DEG * TRAFFIC_HOURLY_CELL_DEG, 6))
+
+def load_traffic_baselines(points, days=TRAFFIC_BASELINE_DAYS):
+    """Load typical vessel counts for the cells of (lat, lon) points from traffic_hourly."""
+    cells = {traffic_hourly_cell(lat, lon) for lat, lon in points if lat is not None and lon is not None}
+    now = datetime.now(timezone.utc)
+    time_threshold = (now - timedelta(days=days)).isoformat()
+    counts = defaultdict(list)
+    
+    cells = sorted(cells)
+    try:
+        for i in range(0, len(cells), HISTORY_CHUNK_SIZE):
+            # Match the exact cells, so only their rows are read
+            chunk = ",".join(f"and(cell_lat.eq.{cell_lat},cell_lon.eq.{cell_lon})"
+                             for cell_lat, cell_lon in cells[i:i + HISTORY_CHUNK_SIZE])
+            offset = 0
+            while True:
+                response = supabase.table("traffic_hourly") \
+                    .select("cell_lat, cell_lon, vessel_count") \
+                    .or_(chunk) \
+                    .eq("hour_of_day", now.hour) \
+                    .gte("hour", time_threshold) \
+                    .order("hour", desc=False) \
+                    .order("cell_lat", desc=False) \
+                    .order("cell_lon", desc=False) \
+                    .range(offset, offset + HISTORY_PAGE_SIZE - 1) \
+                    .execute()
+                
+                for row in response.data:
+                    counts[(round(row["cell_lat"], 6), round(row["cell_lon"], 6))].append(row["vessel_count"])
+                
+                if len(response.data) < HISTORY_PAGE_SIZE:
+                    break
+                offset += HISTORY_PAGE_SIZE
+    except Exception as e:
+        print(f"Error loading traffic baselines: {e}")
+    
+    return {cell: round(sum(values) / len(values), 1) for cell, values in counts.items()}
+
+def load_traffic_index(minutes=TRAFFIC_WINDOW_MINUTES):
+    """Load recent vessel positions once and index them for vicinity lookups."""
+    time_threshold = (datetime.now(timezone.utc) - timedelta(minutes=minutes)).isoformat()
+    positions = []
+    offset = 0
+    try:
+        while True:
+            # vessel_latest holds one row per vessel
+            response = supabase.table("vessel_latest") \
+                .select("mmsi", "lat", "lon") \
+                .gte("timestamp", time_threshold) \
+                .order("mmsi", desc=False) \
+                .range(offset, offset + HISTORY_PAGE_SIZE - 1) \
+                .execute()
+            positions.extend(response.data)
+            if len(response.data) < HISTORY_PAGE_SIZE:
+                break
+            offset += HISTORY_PAGE_SIZE
+    except Exception as e:
+        print(f"Error loading traffic data: {e}")
+        return None
+    
+    return TrafficIndex(positions)
+
+def get_traffic_data(lat, lon, radius_nm=20, traffic_index=None):
+    """Get information about other vessels in the vicinity.
+    
+    traffic_index comes from load_traffic_index(); None means it couldn't be
+    loaded, and is not retried here so a failed load costs one query per
+    batch rather than one per vessel.
+    """
+    if lat is None or lon is None:
         return {
-            "nearby_vessels": vessel_count,
-            "congestion_level": congestion
+            "nearby_vessels": "Unknown",
+            "congestion_level": "Unknown",
+            "typical_vessels": "Unknown"
         }
     
-    except Exception as e:
-        print(f"Error getting traffic data: {e}")
+    if traffic_index is None:
         return {
             "nearby_vessels": "Error",
-            "congestion_level": "Error"
+            "congestion_level": "Error",
+            "typical_vessels": "Error"
         }
+    
+    vessel_count = traffic_index.count_nearby(lat, lon, radius_nm)
+    
+    # Determine congestion level
+    if vessel_count < 5:
+        congestion = "Low"
+    elif vessel_count < 15:
+        congestion = "Medium"
+    else:
+        congestion = "High"
+    
+    typical_vessels = traffic_index.typical_vessels(lat, lon)
+    
+    return {
+        "nearby_vessels": vessel_count,
+        "congestion_level": congestion,
+        "typical_vessels": typical_vessels if typical_vessels is not None else "Unknown"
+    }
 
 def query_huggingface(prompt):
     """Query the Hugging Face API for predictions."""
-    headers = {
-        "Authorization": f"Bearer {HF_API_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    
-    data = {
-        "inputs": prompt,
-        "parameters": {
-            "max_new_tokens": 512,
-            "temperature": 0.7
-        }
-    }
-    
-    try:
-        response = requests.post(HF_API_URL, headers=headers, json=data)
-        
-        if response.status_code == 200:
-            return response.json()[0]["generated_text"]
-        else:
-            print(f"Error querying Hugging Face API: {response.text}")
-            return None
-    except Exception as e:
-        print(f"Exception in Hugging Face API call: {e}")
-        return None
+    return hf_client.generate(prompt, {"max_new_tokens": 512, "temperature": 0.7}, timer=stage_timings.time)
 
 def extract_json_from_response(text):
     """Extract JSON from the LLM response."""
@@ -254,98 +766,275 @@ def extract_json_from_response(text):
         print(f"Error extracting JSON: {e}")
         return None
 
-def save_prediction(vessel_data, prediction_data):
-    """Save the prediction to the database."""
-    try:
-        # Extract values from prediction
-        delay_minutes = prediction_data.get("delay_minutes", 0)
-        if isinstance(delay_minutes, str):
+def prediction_row(vessel_data, prediction_data):
+    """Convert a parsed prediction into a delay_predictions row."""
+    # Extract values from prediction
+    delay_minutes = prediction_data.get("delay_minutes", 0)
+    if isinstance(delay_minutes, str):
+        try:
+            delay_minutes = int(delay_minutes)
+        except:
+            delay_minutes = 0
+    
+    confidence = prediction_data.get("confidence", 0.5)
+    if isinstance(confidence, str):
+        if confidence.lower() == "low":
+            confidence = 0.3
+        elif confidence.lower() == "medium":
+            confidence = 0.6
+        elif confidence.lower() == "high":
+            confidence = 0.9
+        else:
             try:
-                delay_minutes = int(delay_minutes)
+                confidence = float(confidence)
             except:
-                delay_minutes = 0
-        
-        confidence = prediction_data.get("confidence", 0.5)
-        if isinstance(confidence, str):
-            if confidence.lower() == "low":
-                confidence = 0.3
-            elif confidence.lower() == "medium":
-                confidence = 0.6
-            elif confidence.lower() == "high":
-                confidence = 0.9
-            else:
-                try:
-                    confidence = float(confidence)
-                except:
-                    confidence = 0.5
-        
-        reasoning = f"Causes: {prediction_data.get('causes', 'Unknown')}"
-        if "rerouting_suggestion" in prediction_data:
-            reasoning += f"\nRerouting: {prediction_data['rerouting_suggestion']}"
-        
-        # Save to Supabase
-        result = supabase.table("delay_predictions").insert({
-            "mmsi": vessel_data.get("mmsi"),
-            "vessel_name": vessel_data.get("vessel_name"),
-            "predicted_delay_minutes": delay_minutes,
-            "confidence_score": confidence,
-            "reasoning": reasoning,
-            "created_at": datetime.now(datetime.timezone.utc).isoformat()
-        }).execute()
-        
-        # Update prediction queue status
-        supabase.table("prediction_queue") \
+                confidence = 0.5
+    
+    reasoning = f"Causes: {prediction_data.get('causes', 'Unknown')}"
+    if "rerouting_suggestion" in prediction_data:
+        reasoning += f"\nRerouting: {prediction_data['rerouting_suggestion']}"
+    
+    return {
+        "mmsi": vessel_data.get("mmsi"),
+        "vessel_name": vessel_data.get("vessel_name"),
+        "predicted_delay_minutes": delay_minutes,
+        "confidence_score": confidence,
+        "reasoning": reasoning,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+def save_predictions(results, worker_id=None):
+    """Complete the queue jobs of many predictions and save them in two requests.
+    
+    With a worker_id, only jobs this worker still holds are completed, and
+    only their predictions are saved, so a job whose lease was taken over by
+    another worker is left to that worker.
+    """
+    if not results:
+        return []
+    
+    try:
+        # Complete the jobs first; the update returns the jobs we still own
+        query = supabase.table("prediction_queue") \
             .update({"status": "completed"}) \
-            .eq("id", vessel_data.get("id")) \
+            .in_("id", [vessel_data.get("id") for vessel_data, _ in results])
+        if worker_id is not None:
+            query = query.eq("worker_id", worker_id).eq("status", "processing")
+        completed = {row["id"] for row in query.execute().data}
+    except Exception as e:
+        print(f"Error completing {len(results)} prediction jobs: {e}")
+        return None
+    
+    owned = [(vessel_data, prediction_data) for vessel_data, prediction_data in results if vessel_data.get("id") in completed]
+    if len(owned) < len(results):
+        print(f"Dropping {len(results) - len(owned)} predictions whose jobs were taken over by another worker.")
+    if not owned:
+        return []
+    
+    try:
+        # Save to Supabase
+        result = supabase.table("delay_predictions") \
+            .insert([prediction_row(vessel_data, prediction_data) for vessel_data, prediction_data in owned]) \
             .execute()
-        
         return result.data
     except Exception as e:
-        print(f"Error saving prediction: {e}")
+        print(f"Error saving {len(owned)} predictions: {e}")
+        # Hand the jobs back so they are predicted again
+        try:
+            supabase.table("prediction_queue") \
+                .update({"status": "pending", "worker_id": None, "lease_expires_at": None}) \
+                .in_("id", [vessel_data.get("id") for vessel_data, _ in owned]) \
+                .execute()
+        except Exception as e:
+            print(f"Error releasing {len(owned)} prediction jobs: {e}")
         return None
 
-def main():
-    """Main function to process pending predictions."""
-    # Get pending prediction requests
-    pending_predictions = get_pending_prediction_requests()
+def save_prediction(vessel_data, prediction_data):
+    """Save the prediction to the database."""
+    return save_predictions([(vessel_data, prediction_data)])
+
+def predict_batch(pending_predictions, prediction_cache, routes):
+    """Predict delays for a batch of queue jobs.
     
-    if not pending_predictions:
-        print("No pending predictions found.")
-        return
+    Returns (vessel_data, prediction_data) pairs for every job that got a
+    prediction, and counts the route each job took in `routes`.
+    """
+    results = []
     
-    print(f"Found {len(pending_predictions)} pending predictions.")
+    # Use the collector's rolling statistics where available, and fetch and
+    # analyze the history of the remaining vessels up front
+    mmsis = [vessel_data.get("mmsi") for vessel_data in pending_predictions]
+    with stage_timings.time("stats"):
+        movements = get_vessel_stats(mmsis)
+    with stage_timings.time("history"):
+        histories = get_vessel_histories([mmsi for mmsi in mmsis if mmsi not in movements])
+    with stage_timings.time("traffic"):
+        traffic_index = load_traffic_index()
+    if traffic_index is not None:
+        with stage_timings.time("baselines"):
+            positions = [parse_position_data(vessel_data) for vessel_data in pending_predictions]
+            traffic_index.baselines = load_traffic_baselines((p.get("lat"), p.get("lon")) for p in positions)
+    with stage_timings.time("analysis"):
+        movements.update(analyze_movement_batch(histories))
     
-    # Process each prediction request
+    # Answer each prediction request locally or from the cache where possible,
+    # and group the rest by cache key so each distinct situation is sent to
+    # the AI once
+    jobs = {}  # cache key -> (prompt, [vessel_data, ...])
     for vessel_data in pending_predictions:
         print(f"Processing prediction for vessel {vessel_data.get('vessel_name') or vessel_data.get('mmsi')}")
         
         # Get vessel history
-        history = get_vessel_history(vessel_data.get("mmsi"), vessel_data.get("vessel_name"))
+        history = histories.get(vessel_data.get("mmsi"), [])
         
-        # Format data for prediction
-        prompt = format_data_for_prediction(vessel_data, history)
-        if not prompt:
+        # Collect the data the prediction is based on
+        with stage_timings.time("features"):
+            features = collect_prediction_features(vessel_data, history, traffic_index, movements.get(vessel_data.get("mmsi")))
+        if not features:
             print("Insufficient data for prediction, skipping.")
+            routes["skipped"] += 1
             continue
         
-        # Query AI
-        ai_response = query_huggingface(prompt)
-        if not ai_response:
-            print("Failed to get AI response, skipping.")
+        estimate = estimate_delay_locally(features)
+        if estimate["confidence"] >= LOCAL_CONFIDENCE_THRESHOLD:
+            routes["local"] += 1
+            results.append((vessel_data, estimate))
             continue
         
-        # Extract JSON from response
-        prediction_data = extract_json_from_response(ai_response)
-        if not prediction_data:
-            print("Failed to extract prediction data, skipping.")
+        key = prediction_cache_key(features)
+        if key in jobs:
+            jobs[key][1].append(vessel_data)
             continue
         
-        # Save prediction
-        result = save_prediction(vessel_data, prediction_data)
-        if result:
-            print(f"Saved prediction for {vessel_data.get('vessel_name') or vessel_data.get('mmsi')}")
-        else:
-            print(f"Failed to save prediction for {vessel_data.get('vessel_name') or vessel_data.get('mmsi')}")
+        prediction_data = prediction_cache.get(key)
+        if prediction_data is not None:
+            routes["cache"] += 1
+            results.append((vessel_data, prediction_data))
+            continue
+        
+        jobs[key] = (build_prediction_prompt(vessel_data, features), [vessel_data])
+    
+    # Query AI concurrently
+    with stage_timings.time("inference"), ThreadPoolExecutor(max_workers=HF_WORKERS) as executor:
+        futures = {executor.submit(query_huggingface, prompt): key for key, (prompt, _) in jobs.items()}
+        
+        for future in as_completed(futures):
+            key = futures[future]
+            vessels = jobs[key][1]
+            name = vessels[0].get('vessel_name') or vessels[0].get('mmsi')
+            
+            ai_response = future.result()
+            if not ai_response:
+                print(f"Failed to get AI response for {name}, skipping.")
+                routes["failed"] += len(vessels)
+                continue
+            
+            # Extract JSON from response
+            prediction_data = extract_json_from_response(ai_response)
+            if not prediction_data:
+                print(f"Failed to extract prediction data for {name}, skipping.")
+                routes["failed"] += len(vessels)
+                continue
+            
+            routes["ai"] += len(vessels)
+            prediction_cache.put(key, prediction_data)
+            results.extend((vessel_data, prediction_data) for vessel_data in vessels)
+    
+    return results
+
+def main(worker=False, timings_file=None):
+    """Claim and process pending predictions.
+    
+    By default the queue is drained and the run ends; with worker=True the
+    worker keeps polling for new jobs until interrupted (SIGINT or SIGTERM).
+    Per-stage timings are printed at the end of the run, and every
+    TIMINGS_REPORT_BATCHES batches in worker mode, and also written to
+    timings_file when given.
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    prediction_cache = PredictionCache(PREDICTION_CACHE_FILE, PREDICTION_CACHE_TTL, PREDICTION_CACHE_SIZE)
+    prediction_cache.load()
+    routes = Counter()
+    claimed = 0
+    batches = 0
+    
+    # Stop a worker the same way on SIGTERM as on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    
+    try:
+        while True:
+            # Claim a batch of pending prediction requests
+            with stage_timings.time("claim"):
+                pending_predictions = claim_prediction_jobs(worker_id)
+            
+            if not pending_predictions:
+                if not worker:
+                    break
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            
+            claimed += len(pending_predictions)
+            print(f"Claimed {len(pending_predictions)} pending predictions.")
+            
+            with stage_timings.time("batch"):
+                results = predict_batch(pending_predictions, prediction_cache, routes)
+            
+            # Save predictions
+            with stage_timings.time("save"):
+                saved = save_predictions(results, worker_id)
+            if saved is not None:
+                print(f"Saved {len(saved)} predictions.")
+            else:
+                print(f"Failed to save {len(results)} predictions; their jobs will be retried.")
+            
+            with stage_timings.time("cache_save"):
+                prediction_cache.save()
+            
+            # A long-running worker reports its timings periodically, so they
+            # are seen and don't grow without bound
+            batches += 1
+            if worker and batches % TIMINGS_REPORT_BATCHES == 0:
+                report_run(prediction_cache, routes, timings_file)
+                stage_timings.reset()
+            
+            # A one-off run stops once it has caught up with the queue
+            if not worker and len(pending_predictions) < CLAIM_BATCH_SIZE:
+                break
+    except KeyboardInterrupt:
+        print("Interrupted, stopping.")
+    
+    if not claimed:
+        if timings_file:
+            stage_timings.write_json(timings_file)
+        print("No pending predictions found.")
+        return
+    
+    report_run(prediction_cache, routes, timings_file)
+
+def report_run(prediction_cache, routes, timings_file=None):
+    """Print cache, route and stage timing statistics, and write the timings to timings_file."""
+    if timings_file:
+        stage_timings.write_json(timings_file)
+    print(f"Prediction cache: {prediction_cache.hits} hits, {prediction_cache.misses} misses "
+          f"({prediction_cache.hit_rate():.0%} hit rate)")
+    print("Routes: " + ", ".join(f"{route} {routes[route]}" for route in ("local", "cache", "ai", "failed", "skipped")))
+    stage_timings.report()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Predict vessel delays for queued prediction jobs.")
+    parser.add_argument("--worker", action="store_true", help="keep polling for new jobs instead of exiting when the queue is empty")
+    parser.add_argument("--timings", metavar="PATH", help="write per-stage timings as JSON to PATH")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="profile the run with cProfile and write the stats to PATH "
+                             "(view with snakeviz, or convert to a flame graph with flameprof)")
+    args = parser.parse_args()
+    
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main, worker=args.worker, timings_file=args.timings)
+        finally:
+            profiler.dump_stats(args.profile)
+            print(f"Wrote profile to {args.profile}")
+    else:
+        main(worker=args.worker, timings_file=args.timings)
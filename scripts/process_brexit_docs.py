@@ -1,11 +1,19 @@
 import os
 import glob
+import hashlib
+import json
+import re
 import requests
 import pytesseract
 import io
+import subprocess
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
 from PIL import Image
 from supabase import create_client, Client
-from pdf2image import convert_from_path, convert_from_bytes
+from hf_client import HFClient
+from pdf2image import convert_from_path, convert_from_bytes, pdfinfo_from_path
 
 # Supabase setup
 supabase_url = os.environ.get("SUPABASE_URL")
@@ -16,18 +24,103 @@ supabase = create_client(supabase_url, supabase_key)
 HF_API_TOKEN = os.environ.get("HF_API_TOKEN")
 HF_API_URL = "https://api-inference.huggingface.co/models/mistralai/Mixtral-8x7B-v0.1"
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from a PDF document."""
+# Long documents are analyzed map-reduce style: the text is split into chunks
+# of about CHUNK_TOKENS tokens (estimated at CHARS_PER_TOKEN characters per
+# token), each chunk is analyzed by one of ANALYSIS_WORKERS concurrent calls
+# limited to HF_REQUESTS_PER_SECOND, and the per-chunk results are merged.
+# Failed calls (timeouts, 429, 5xx) are retried up to HF_MAX_RETRIES times,
+# waiting for the server's Retry-After/estimated_time when given and a
+# jittered exponential backoff otherwise.
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", "3000"))
+CHARS_PER_TOKEN = 4
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "8"))
+HF_REQUESTS_PER_SECOND = float(os.environ.get("HF_REQUESTS_PER_SECOND", "2"))
+HF_MAX_RETRIES = int(os.environ.get("HF_MAX_RETRIES", "4"))
+HF_TIMEOUT = float(os.environ.get("HF_TIMEOUT", "120"))
+HF_BACKOFF_BASE = float(os.environ.get("HF_BACKOFF_BASE", "1"))
+HF_BACKOFF_MAX = float(os.environ.get("HF_BACKOFF_MAX", "60"))
+
+hf_client = HFClient(HF_API_URL, HF_API_TOKEN, ANALYSIS_WORKERS, HF_REQUESTS_PER_SECOND, HF_TIMEOUT,
+                     HF_MAX_RETRIES, HF_BACKOFF_BASE, HF_BACKOFF_MAX)
+
+# PDF pages are rasterized at OCR_DPI and OCR'd one page at a time by
+# OCR_WORKERS processes, so at most OCR_WORKERS page images are in memory
+# at once regardless of the document's length
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_DPI = int(os.environ.get("OCR_DPI", "200"))
+
+# Born-digital PDFs carry a text layer, which pdftotext (poppler, already
+# needed by pdf2image) reads far faster than OCR. A page's embedded text is
+# used when it has at least TEXT_LAYER_MIN_CHARS letters or digits; scanned
+# and image-only pages fall back to OCR. Pages per path are counted in
+# page_sources for the run summary.
+TEXT_LAYER_MIN_CHARS = int(os.environ.get("TEXT_LAYER_MIN_CHARS", "50"))
+page_sources = Counter()
+
+# Documents are identified by the SHA-256 of their content, stored in
+# brexit_documents.content_hash, so renamed files are recognised and changed
+# files are reprocessed. The analysis of a changed file replaces the rows
+# saved for its earlier content, and rows saved before hashes were recorded
+# get the hash of the file of the same name the first time it is seen.
+# Extracted text is cached under TEXT_CACHE_DIR by hash, so a document is
+# never OCR'd twice.
+TEXT_CACHE_DIR = os.environ.get("TEXT_CACHE_DIR", ".cache/document_text")
+MANIFEST_PAGE_SIZE = 1000
+
+def init_ocr_worker():
+    """Keep each Tesseract process single-threaded; the pool provides the parallelism."""
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def ocr_pdf_page(pdf_path, page_number, dpi):
+    """Rasterize a single PDF page and OCR it."""
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number)
     try:
-        # Convert PDF to images
-        images = convert_from_path(pdf_path)
-        
-        # Extract text from each image
-        text = ""
+        return "".join(pytesseract.image_to_string(img) for img in images)
+    finally:
         for img in images:
-            text += pytesseract.image_to_string(img)
+            img.close()
+
+def extract_text_layer(pdf_path, page_count):
+    """Return the embedded text of every page, "" for pages without usable text."""
+    try:
+        output = subprocess.run(
+            ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+            capture_output=True, check=True
+        ).stdout.decode("utf-8", errors="replace")
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Could not read the text layer of {pdf_path}, using OCR: {e}")
+        return [""] * page_count
+    
+    # pdftotext ends every page with a form feed
+    texts = output.split("\f")[:page_count]
+    texts += [""] * (page_count - len(texts))
+    return [
+        text if sum(c.isalnum() for c in text) >= TEXT_LAYER_MIN_CHARS else ""
+        for text in texts
+    ]
+
+def extract_text_from_pdf(pdf_path, ocr_pool=None, dpi=OCR_DPI):
+    """Extract text from a PDF document.
+    
+    Embedded text is used where pages have it; the remaining pages are OCR'd
+    on `ocr_pool` when given, serially otherwise.
+    """
+    try:
+        page_count = pdfinfo_from_path(pdf_path)["Pages"]
+        texts = extract_text_layer(pdf_path, page_count)
+        ocr_pages = [page for page, text in enumerate(texts, start=1) if not text]
+        page_sources["text layer"] += page_count - len(ocr_pages)
+        page_sources["ocr"] += len(ocr_pages)
         
-        return text
+        # OCR the pages without a usable text layer
+        if ocr_pool is None:
+            ocr_texts = (ocr_pdf_page(pdf_path, page, dpi) for page in ocr_pages)
+        else:
+            ocr_texts = ocr_pool.map(ocr_pdf_page, [pdf_path] * len(ocr_pages), ocr_pages, [dpi] * len(ocr_pages))
+        for page, text in zip(ocr_pages, ocr_texts):
+            texts[page - 1] = text
+        
+        return "\n".join(texts)
     except Exception as e:
         print(f"Error extracting text from PDF {pdf_path}: {e}")
         return None
@@ -42,75 +135,238 @@ def extract_text_from_image(image_path):
         print(f"Error extracting text from image {image_path}: {e}")
         return None
 
-def document_already_processed(document_name):
-    """Check if a document has already been processed."""
+def file_sha256(path):
+    """Return the hex SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_processed_documents():
+    """Fetch the content hashes and names of all processed documents.
+    
+    Returns (hashes, legacy_names), where legacy_names are the names of rows
+    saved before content hashes were recorded. Returns None on failure.
+    """
+    hashes, legacy_names = set(), set()
+    offset = 0
     try:
-        response = supabase.table("brexit_documents") \
-            .select("id") \
+        while True:
+            response = supabase.table("brexit_documents") \
+                .select("document_name, content_hash") \
+                .order("id", desc=False) \
+                .range(offset, offset + MANIFEST_PAGE_SIZE - 1) \
+                .execute()
+            
+            for row in response.data:
+                if row.get("content_hash"):
+                    hashes.add(row["content_hash"])
+                else:
+                    legacy_names.add(row.get("document_name"))
+            
+            if len(response.data) < MANIFEST_PAGE_SIZE:
+                break
+            offset += MANIFEST_PAGE_SIZE
+    except Exception as e:
+        print(f"Error fetching processed documents: {e}")
+        return None
+    
+    return hashes, legacy_names
+
+def backfill_content_hash(document_name, content_hash):
+    """Record the content hash of a document's rows saved before hashes were."""
+    try:
+        supabase.table("brexit_documents") \
+            .update({"content_hash": content_hash}) \
             .eq("document_name", document_name) \
+            .is_("content_hash", "null") \
             .execute()
-        
-        return len(response.data) > 0
+        return True
     except Exception as e:
-        print(f"Error checking if document exists: {e}")
+        print(f"Error recording content hash of {document_name}: {e}")
         return False
 
-def process_brexit_doc(document_name, document_type, text):
-    """Process the document text with an AI model."""
+def delete_stale_analyses(document_name, current_hashes):
+    """Delete a document's rows whose content is no longer in any file of that name."""
+    try:
+        supabase.table("brexit_documents") \
+            .delete() \
+            .eq("document_name", document_name) \
+            .not_.in_("content_hash", list(current_hashes)) \
+            .execute()
+    except Exception as e:
+        print(f"Error deleting outdated analyses of {document_name}: {e}")
+
+def load_cached_text(content_hash):
+    """Return previously extracted text for a content hash, or None."""
+    try:
+        with open(os.path.join(TEXT_CACHE_DIR, f"{content_hash}.txt"), encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def save_cached_text(content_hash, text):
+    """Cache extracted text under its content hash."""
+    path = os.path.join(TEXT_CACHE_DIR, f"{content_hash}.txt")
+    try:
+        os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Error caching extracted text: {e}")
+
+def split_into_chunks(text, max_tokens=CHUNK_TOKENS):
+    """Split text into chunks of at most max_tokens estimated tokens.
+    
+    Chunks are packed from whole paragraphs; paragraphs longer than a chunk
+    are split on line breaks, and lines longer than a chunk are cut.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for line in paragraph.splitlines():
+            pieces.extend(line[i:i + max_chars] for i in range(0, len(line), max_chars))
+    
+    chunks, current, size = [], [], 0
+    for piece in pieces:
+        if not piece.strip():
+            continue
+        if current and size + len(piece) + 2 > max_chars:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(piece)
+        size += len(piece) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def query_model(prompt, max_new_tokens):
+    """Query the Hugging Face API, returning only the generated text."""
+    return hf_client.generate(prompt, {
+        "max_new_tokens": max_new_tokens,
+        "temperature": 0.3,
+        "return_full_text": False
+    })
+
+def extract_json(result):
+    """Extract the JSON object from a model response."""
+    if not result:
+        return None
+    start_idx = result.find('{')
+    end_idx = result.rfind('}') + 1
+    if start_idx >= 0 and end_idx > start_idx:
+        try:
+            return json.loads(result[start_idx:end_idx])
+        except ValueError as e:
+            print(f"Error parsing AI response: {e}")
+    return None
+
+def analyze_chunk(document_name, document_type, chunk, part, parts):
+    """Extract the analysis of one chunk of a document."""
     prompt = f"""
     Task: Analyze the following Brexit document text for port and shipping operations.
     
     Document: {document_name}
     Type: {document_type}
+    Part: {part} of {parts}
     
     Text:
-    {text[:4000]}  # Limit text length to stay within context window
+    {chunk}
     
-    Please provide:
-    1. A concise summary of the document's key points (max 3 paragraphs)
+    Please provide, for this part of the document only:
+    1. A concise summary of its key points (max 1 paragraph)
     2. A list of specific action items that logistics managers, port authorities, or shipping companies need to take
     3. Any deadlines or important dates mentioned
     4. Any specific requirements for different ports or countries
     
     Format your response as JSON with the keys: "summary", "action_items", "deadlines", "port_requirements"
+    Use lists of strings for "action_items", "deadlines" and "port_requirements".
     """
+    return extract_json(query_model(prompt, 1024))
+
+def _as_list(value):
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        return value.splitlines()
+    return value if isinstance(value, list) else [value]
+
+def _item_text(item):
+    """Render a list item as a single line of text."""
+    text = item if isinstance(item, str) else json.dumps(item, ensure_ascii=False)
+    return " ".join(text.split())
+
+def _dedup_key(text):
+    return re.sub(r"[\W_]+", " ", text).strip().casefold()
+
+def merge_analyses(document_name, analyses):
+    """Merge per-chunk analyses into one, in document order.
     
-    headers = {
-        "Authorization": f"Bearer {HF_API_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    List fields are concatenated with duplicates (ignoring case, spacing and
+    punctuation) removed, and stored one item per line as the frontend
+    expects; the chunk summaries are condensed with one more
+    model call, or joined if that fails.
+    """
+    merged = {}
+    for key in ("action_items", "deadlines", "port_requirements"):
+        items, seen = [], set()
+        for analysis in analyses:
+            for item in _as_list(analysis.get(key)):
+                text = _item_text(item)
+                dedup_key = _dedup_key(text)
+                if dedup_key and dedup_key not in seen:
+                    seen.add(dedup_key)
+                    items.append(text)
+        merged[key] = "\n".join(items)
     
-    data = {
-        "inputs": prompt,
-        "parameters": {
-            "max_new_tokens": 1024,
-            "temperature": 0.3
-        }
-    }
+    summaries = [str(analysis.get("summary", "")).strip() for analysis in analyses]
+    summaries = [summary for summary in summaries if summary]
+    merged["summary"] = summaries[0] if len(summaries) == 1 else "\n\n".join(summaries)
+    if len(summaries) > 1:
+        prompt = f"""
+    Task: Combine these summaries of consecutive parts of the Brexit document {document_name} into a concise summary of the whole document's key points for port and shipping operations (max 3 paragraphs).
     
-    try:
-        response = requests.post(HF_API_URL, headers=headers, json=data)
-        
-        if response.status_code == 200:
-            result = response.json()[0]["generated_text"]
-            
-            # Extract JSON
-            start_idx = result.find('{')
-            end_idx = result.rfind('}') + 1
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = result[start_idx:end_idx]
-                import json
-                data = json.loads(json_str)
-                return data
-        else:
-            print(f"Error in API response: {response.text}")
-            
-    except Exception as e:
-        print(f"Error processing document with AI: {e}")
-            
-    return None
+    {chr(10).join(f"Part {i}: {summary}" for i, summary in enumerate(summaries, start=1))}
+    
+    Respond with the summary text only.
+    """
+        summary = query_model(prompt, 512)
+        if summary and summary.strip():
+            merged["summary"] = summary.strip()
+    
+    return merged
+
+def process_brexit_doc(document_name, document_type, text):
+    """Process the document text with an AI model.
+    
+    The text is analyzed in chunks concurrently and the results are merged,
+    so the whole document is covered.
+    """
+    chunks = split_into_chunks(text)
+    if not chunks:
+        return None
+    
+    with ThreadPoolExecutor(max_workers=min(ANALYSIS_WORKERS, len(chunks))) as executor:
+        analyses = list(executor.map(
+            lambda args: analyze_chunk(document_name, document_type, args[1], args[0], len(chunks)),
+            enumerate(chunks, start=1)
+        ))
+    
+    failed = sum(analysis is None for analysis in analyses)
+    if failed:
+        print(f"Failed to analyze {failed} of {len(chunks)} parts of {document_name}")
+    analyses = [analysis for analysis in analyses if isinstance(analysis, dict)]
+    if not analyses:
+        return None
+    
+    return merge_analyses(document_name, analyses)
 
-def save_document_analysis(document_name, document_type, analysis):
+def save_document_analysis(document_name, document_type, analysis, content_hash=None):
     """Save the document analysis to the database."""
     if not analysis:
         return None
@@ -124,7 +380,8 @@ def save_document_analysis(document_name, document_type, analysis):
             "action_items": analysis.get("action_items", ""),
             "deadlines": analysis.get("deadlines", ""),
             "port_requirements": analysis.get("port_requirements", ""),
-            "created_at": datetime.now(datetime.timezone.utc).isoformat()
+            "content_hash": content_hash,
+            "created_at": datetime.now(timezone.utc).isoformat()
         }).execute()
         
         return result.data
@@ -147,44 +404,81 @@ def main():
     
     print(f"Found {len(all_documents)} documents. Checking for new documents...")
     
-    # Process each document
-    for document_path in all_documents:
-        document_name = os.path.basename(document_path)
-        document_type = os.path.splitext(document_name)[1][1:].lower()
-        
-        # Check if document has already been processed
-        if document_already_processed(document_name):
-            print(f"Document {document_name} has already been processed, skipping.")
-            continue
-        
-        print(f"Processing new document: {document_name}")
-        
-        # Extract text based on document type
-        if document_type == 'pdf':
-            text = extract_text_from_pdf(document_path)
-        elif document_type in ['jpg', 'jpeg', 'png']:
-            text = extract_text_from_image(document_path)
-        else:
-            # Assume plain text
-            with open(document_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-        
-        if not text:
-            print(f"Failed to extract text from {document_name}, skipping.")
-            continue
-        
-        # Process with AI
-        analysis = process_brexit_doc(document_name, document_type, text)
-        
-        # Save results
-        if analysis:
-            result = save_document_analysis(document_name, document_type, analysis)
-            if result:
-                print(f"Successfully processed and saved analysis for {document_name}")
+    # Fetch what has been processed already in one go
+    processed = get_processed_documents()
+    if processed is None:
+        print("Could not determine which documents were processed, aborting.")
+        return
+    processed_hashes, legacy_names = processed
+    
+    # Hash everything first, so a changed document's outdated rows can be
+    # told apart from those of other files with the same name
+    content_hashes = {path: file_sha256(path) for path in all_documents}
+    name_hashes = defaultdict(set)
+    for document_path, content_hash in content_hashes.items():
+        name_hashes[os.path.basename(document_path)].add(content_hash)
+    
+    # Process each document, sharing one pool of OCR workers
+    with ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=init_ocr_worker) as ocr_pool:
+        for document_path in all_documents:
+            document_name = os.path.basename(document_path)
+            document_type = os.path.splitext(document_name)[1][1:].lower()
+            content_hash = content_hashes[document_path]
+            
+            # Check if this content has already been processed, under any name
+            if content_hash in processed_hashes:
+                print(f"Document {document_name} has already been processed, skipping.")
+                continue
+            
+            # Rows saved before hashes were recorded are taken to match the
+            # file as it is now; from here on, changes to it are picked up
+            if document_name in legacy_names:
+                if backfill_content_hash(document_name, content_hash):
+                    legacy_names.discard(document_name)
+                    processed_hashes.add(content_hash)
+                print(f"Document {document_name} has already been processed, skipping.")
+                continue
+            
+            print(f"Processing new document: {document_name}")
+            
+            # Extract text based on document type, reusing earlier extractions
+            text = load_cached_text(content_hash)
+            cached = text is not None
+            if cached:
+                print(f"Using cached text for {document_name}")
+            elif document_type == 'pdf':
+                text = extract_text_from_pdf(document_path, ocr_pool)
+            elif document_type in ['jpg', 'jpeg', 'png']:
+                text = extract_text_from_image(document_path)
             else:
-                print(f"Failed to save analysis for {document_name}")
-        else:
-            print(f"Failed to get analysis for {document_name}")
+                # Assume plain text
+                with open(document_path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+            
+            if not text:
+                print(f"Failed to extract text from {document_name}, skipping.")
+                continue
+            
+            if not cached and document_type != 'txt':
+                save_cached_text(content_hash, text)
+            
+            # Process with AI
+            analysis = process_brexit_doc(document_name, document_type, text)
+            
+            # Save results
+            if analysis:
+                result = save_document_analysis(document_name, document_type, analysis, content_hash)
+                if result:
+                    processed_hashes.add(content_hash)
+                    delete_stale_analyses(document_name, name_hashes[document_name])
+                    print(f"Successfully processed and saved analysis for {document_name}")
+                else:
+                    print(f"Failed to save analysis for {document_name}")
+            else:
+                print(f"Failed to get analysis for {document_name}")
+    
+    if page_sources:
+        print(f"PDF pages: {page_sources['text layer']} read from the text layer, {page_sources['ocr']} OCR'd")
 
 if __name__ == "__main__":
     main()
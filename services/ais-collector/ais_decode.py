@@ -0,0 +1,108 @@
+"""Decode aisstream.io PositionReport frames into position records.
+
+Only the fields the collector stores are pulled out of each frame: UserID,
+Latitude, Longitude, Sog, Cog and the MetaData time_utc timestamp. When
+msgspec is installed (pip install msgspec) frames are decoded with a typed
+schema that skips everything else; otherwise the standard json module is used.
+Both paths return the same record, and both raise (msgspec.ValidationError or
+ValueError) on frames whose fields don't have the schema's types, such as a
+string UserID.
+"""
+import json
+from datetime import datetime, timezone
+from typing import Optional
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+def parse_time_utc(value):
+    """Convert aisstream's "2022-12-29 18:22:32.318353 +0000 UTC" to ISO 8601."""
+    try:
+        date, clock, offset = value.split(" ")[:3]
+        return f"{date}T{clock}{offset[:3]}:{offset[3:]}"
+    except (AttributeError, ValueError):
+        return datetime.now(timezone.utc).isoformat()
+
+def _typed(obj, name, types):
+    """Return obj[name] (None if missing), raising ValueError unless it is null or of types."""
+    value = obj.get(name)
+    if value is not None and (not isinstance(value, types) or isinstance(value, bool)):
+        raise ValueError(f"Expected {name} to be {' or '.join(t.__name__ for t in types)}, got {value!r}")
+    return value
+
+def decode_position_report_json(frame):
+    """Decode a frame with the json module, returning None if it isn't a PositionReport."""
+    message = json.loads(frame)
+    if not isinstance(message, dict):
+        raise ValueError(f"Expected an object, got {message!r}")
+
+    # Check the same fields, with the same types, as the msgspec schema, so
+    # both paths reject the same frames
+    message_type = _typed(message, "MessageType", (str,))
+    ais_message = _typed(_typed(message, "Message", (dict,)) or {}, "PositionReport", (dict,))
+    time_utc = _typed(_typed(message, "MetaData", (dict,)) or {}, "time_utc", (str,))
+    if ais_message is not None:
+        mmsi = _typed(ais_message, "UserID", (int,))
+        lat, lon, speed, course = (
+            _typed(ais_message, name, (int, float)) for name in ("Latitude", "Longitude", "Sog", "Cog")
+        )
+
+    if message_type != "PositionReport" or ais_message is None:
+        return None
+
+    return {
+        "mmsi": mmsi,
+        "lat": lat,
+        "lon": lon,
+        "speed": speed,  # Speed Over Ground
+        "course": course,  # Course Over Ground
+        "timestamp": parse_time_utc(time_utc)
+    }
+
+if msgspec is not None:
+    class _PositionReport(msgspec.Struct):
+        UserID: Optional[int] = None
+        Latitude: Optional[float] = None
+        Longitude: Optional[float] = None
+        Sog: Optional[float] = None
+        Cog: Optional[float] = None
+
+    class _Message(msgspec.Struct):
+        PositionReport: Optional[_PositionReport] = None
+
+    class _MetaData(msgspec.Struct):
+        time_utc: Optional[str] = None
+
+    class _Envelope(msgspec.Struct):
+        MessageType: Optional[str] = None
+        Message: Optional[_Message] = None
+        MetaData: Optional[_MetaData] = None
+
+    _envelope_decoder = msgspec.json.Decoder(_Envelope)
+
+    def decode_position_report_msgspec(frame):
+        """Decode a frame with the typed msgspec schema, returning None if it isn't a PositionReport."""
+        envelope = _envelope_decoder.decode(frame)
+        if envelope.MessageType != "PositionReport" or envelope.Message is None:
+            return None
+        ais_message = envelope.Message.PositionReport
+        if ais_message is None:
+            return None
+
+        return {
+            "mmsi": ais_message.UserID,
+            "lat": ais_message.Latitude,
+            "lon": ais_message.Longitude,
+            "speed": ais_message.Sog,
+            "course": ais_message.Cog,
+            "timestamp": parse_time_utc(envelope.MetaData.time_utc if envelope.MetaData else None)
+        }
+
+    decode_position_report = decode_position_report_msgspec
+else:
+    decode_position_report_msgspec = None
+    decode_position_report = decode_position_report_json
+
+FAST_DECODE = msgspec is not None
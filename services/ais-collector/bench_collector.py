@@ -0,0 +1,118 @@
+"""Offline throughput benchmark for the AIS collector.
+
+Usage: python bench_collector.py recording.jsonl.gz [--speed max] [--db-latency 0.05]
+
+Replays a recording made with `python replay.py record` from a local websocket
+server in a separate process, and runs the collector from main.py against it
+with the in-memory database from memory_db.py. Collector settings are read
+from the environment as usual, so any of them can be varied between runs.
+
+Reports sustained messages/sec, end-to-end latency percentiles (frame sent to
+row written in vessel_positions) and database calls per message.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime
+
+import memory_db
+import replay
+
+def run_replay(path, port, speed, ready):
+    """Entry point of the replay server process."""
+    asyncio.run(replay.serve_replay(replay.load_recording(path), port, speed, ready=ready))
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def run_collector(collector, replay_process, total_frames, spool_dir):
+    """Run the collector until the replay is fully consumed, then shut it down."""
+    start = time.perf_counter()
+    task = asyncio.create_task(collector.main(collector.WORLDWIDE, spool_dir, 0))
+
+    # Wait for the replay to finish and for the collector to stop receiving
+    last_received, idle_since = -1, None
+    while True:
+        await asyncio.sleep(0.1)
+        received = collector.messages_received.get()
+        if received >= total_frames:
+            break
+        if replay_process.is_alive():
+            continue
+        if received != last_received:
+            last_received, idle_since = received, time.perf_counter()
+        elif time.perf_counter() - idle_since > 2:
+            break
+    received_at = time.perf_counter()
+
+    task.cancel()
+    await task
+    return start, received_at, time.perf_counter()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=replay.parse_speed, default=0, help="replay speed multiplier or max (default)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--db-latency", type=float, default=0.0, help="simulated seconds per database call")
+    args = parser.parse_args()
+
+    total_frames = len(replay.load_recording(args.recording))
+    spool_dir = os.environ.get("SPOOL_DIR", tempfile.mkdtemp(prefix="ais-bench-spool-"))
+
+    # Point the collector at the replay server and the in-memory database
+    os.environ["AIS_STREAM_URL"] = f"ws://127.0.0.1:{args.port}"
+    supabase_module = types.ModuleType("supabase")
+    supabase_module.Client = memory_db.InMemoryClient
+    supabase_module.create_client = lambda url, key: memory_db.create_client(url, key, latency=args.db_latency)
+    sys.modules["supabase"] = supabase_module
+    import main as collector
+
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Event()
+    replay_process = ctx.Process(target=run_replay, args=(args.recording, args.port, args.speed, ready))
+    replay_process.start()
+    ready.wait()
+
+    try:
+        start, received_at, end = asyncio.run(run_collector(collector, replay_process, total_frames, spool_dir))
+    finally:
+        replay_process.terminate()
+        replay_process.join()
+
+    db = collector.supabase
+    latencies = sorted(
+        written_at - datetime.fromisoformat(row["timestamp"]).timestamp()
+        for table, written_at, rows in db.write_log if table == "vessel_positions"
+        for row in rows
+    )
+    decoded = collector.messages_decoded.get()
+    calls = sum(db.calls.values())
+
+    print()
+    print(f"Frames replayed:      {total_frames}")
+    print(f"Messages received:    {collector.messages_received.get()}")
+    print(f"Messages decoded:     {decoded}")
+    print(f"Positions suppressed: {collector.positions_suppressed.get()}")
+    print(f"Positions written:    {collector.rows_written.get('vessel_positions')}")
+    for (reason,), count in sorted(collector.messages_dropped.values.items()):
+        print(f"Dropped ({reason}):{' ' * max(1, 13 - len(reason))}{count}")
+    print(f"Wall time:            {end - start:.2f} s (all frames received after {received_at - start:.2f} s)")
+    print(f"Sustained rate:       {decoded / (received_at - start):,.0f} msg/s received, "
+          f"{decoded / (end - start):,.0f} msg/s end to end")
+    print(f"Latency (ms):         p50 {percentile(latencies, 50) * 1000:.1f}  p95 {percentile(latencies, 95) * 1000:.1f}  "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}  max {percentile(latencies, 100) * 1000:.1f}")
+    print(f"DB calls:             {calls} ({calls / decoded if decoded else 0:.4f} per message)")
+    for (table, operation), count in sorted(db.calls.items()):
+        print(f"  {table}.{operation}: {count}")
+
+if __name__ == "__main__":
+    main()
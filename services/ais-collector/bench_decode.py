@@ -0,0 +1,111 @@
+"""Micro-benchmark for PositionReport decoding.
+
+Usage: python bench_decode.py [number_of_messages]
+
+Times the json and (if installed) msgspec decode paths from ais_decode.py
+over a batch of synthetic aisstream.io frames and prints the per-message cost.
+"""
+import json
+import random
+import sys
+import time
+
+from ais_decode import decode_position_report_json, decode_position_report_msgspec
+
+def make_frame(rng):
+    """Build a frame shaped like an aisstream.io PositionReport."""
+    mmsi = rng.randint(200000000, 775999999)
+    lat = rng.uniform(-90, 90)
+    lon = rng.uniform(-180, 180)
+    return json.dumps({
+        "Message": {
+            "PositionReport": {
+                "Cog": round(rng.uniform(0, 360), 1),
+                "CommunicationState": rng.randint(0, 100000),
+                "Latitude": lat,
+                "Longitude": lon,
+                "MessageID": 1,
+                "NavigationalStatus": rng.randint(0, 15),
+                "PositionAccuracy": True,
+                "Raim": False,
+                "RateOfTurn": rng.randint(-127, 127),
+                "RepeatIndicator": 0,
+                "Sog": round(rng.uniform(0, 25), 1),
+                "Spare": 0,
+                "SpecialManoeuvreIndicator": 0,
+                "Timestamp": rng.randint(0, 59),
+                "TrueHeading": rng.randint(0, 359),
+                "UserID": mmsi,
+                "Valid": True
+            }
+        },
+        "MessageType": "PositionReport",
+        "MetaData": {
+            "MMSI": mmsi,
+            "MMSI_String": mmsi,
+            "ShipName": "BENCHMARK VESSEL    ",
+            "latitude": lat,
+            "longitude": lon,
+            "time_utc": "2024-03-01 12:34:56.789012345 +0000 UTC"
+        }
+    })
+
+# Frames the two decode paths must treat the same way
+EDGE_FRAMES = [
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": {"UserID": 1, "Sog": 1}}, "MetaData": null}',
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": {"UserID": 1}}}',
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": {"UserID": "1"}}}',
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": {"UserID": 1.5}}}',
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": {"UserID": true}}}',
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": {"Latitude": "51.9"}}}',
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": {"UserID": 1}}, "MetaData": {"time_utc": 5}}',
+    '{"MessageType": "PositionReport", "Message": {"PositionReport": null}}',
+    '{"MessageType": "PositionReport", "Message": null}',
+    '{"MessageType": "PositionReport"}',
+    '{"MessageType": "ShipStaticData", "Message": {"ShipStaticData": {}}}',
+    '{"MessageType": 5}',
+    '{"error": "Api Key Is Not Valid"}',
+    '[]',
+]
+
+def decode_outcome(decode, frame):
+    """Return what decoding a frame gives: its record or None, or "error" if it raised."""
+    try:
+        record = decode(frame)
+    except Exception:
+        return "error"
+    if record is not None and "time_utc" not in frame:
+        # Without a time_utc both paths stamp the current time
+        record["timestamp"] = None
+    return record
+
+def check_equivalence(frames):
+    """Assert the json and msgspec paths agree on every frame."""
+    for frame in frames:
+        expected = decode_outcome(decode_position_report_json, frame)
+        actual = decode_outcome(decode_position_report_msgspec, frame)
+        assert actual == expected, f"{frame}: msgspec gave {actual!r}, json gave {expected!r}"
+
+def bench(name, decode, frames):
+    """Decode every frame and print the per-message cost."""
+    start = time.perf_counter()
+    for frame in frames:
+        decode(frame)
+    elapsed = time.perf_counter() - start
+    print(f"{name:8s} {elapsed / len(frames) * 1e6:8.2f} us/msg {len(frames) / elapsed:12,.0f} msg/s")
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(42)
+    frames = [make_frame(rng) for _ in range(count)]
+    print(f"Decoding {count} PositionReport frames")
+
+    bench("json", decode_position_report_json, frames)
+    if decode_position_report_msgspec is not None:
+        check_equivalence(frames[:1000] + EDGE_FRAMES)
+        bench("msgspec", decode_position_report_msgspec, frames)
+    else:
+        print("msgspec not installed, skipping fast path")
+
+if __name__ == "__main__":
+    main()
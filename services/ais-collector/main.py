@@ -1,9 +1,17 @@
 import asyncio
 import websockets
 import json
+import math
+import multiprocessing
 import os
+import signal
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 from supabase import create_client, Client
+from ais_decode import FAST_DECODE, decode_position_report
+from spool import Spool
+from metrics import Counter, Gauge, Histogram, Registry, serve as serve_metrics
 
 # Supabase setup
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
@@ -12,19 +20,600 @@ supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # AIS Stream API key
 AIS_API_KEY = os.environ.get("AIS_API_KEY", "your_ais_stream_api_key")
+AIS_STREAM_URL = os.environ.get("AIS_STREAM_URL", "wss://stream.aisstream.io/v0/stream")
 
-async def connect_ais_stream():
-    """Connect to the AIS Stream WebSocket and process vessel position data."""
+# Metrics are served on http://METRICS_HOST:METRICS_PORT/metrics (shard i of a
+# sharded run uses METRICS_PORT + i). Set METRICS_PORT to 0 to disable.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
+# Position reports are logged at most once every POSITION_LOG_INTERVAL seconds
+POSITION_LOG_INTERVAL = float(os.environ.get("POSITION_LOG_INTERVAL", "10"))
+
+registry = Registry()
+messages_received = Counter(registry, "ais_messages_received_total", "Frames received from the AIS stream")
+messages_decoded = Counter(registry, "ais_messages_decoded_total", "PositionReports decoded from the AIS stream")
+messages_dropped = Counter(registry, "ais_messages_dropped_total", "Messages dropped before reaching the database", labels=("reason",))
+positions_suppressed = Counter(registry, "ais_positions_suppressed_total", "Position reports suppressed by the movement filter")
+rows_written = Counter(registry, "ais_rows_written_total", "Rows written to the database", labels=("table",))
+db_write_seconds = Histogram(registry, "ais_db_write_seconds", "Latency of batched database writes")
+db_batch_size = Histogram(registry, "ais_db_batch_size", "Rows per batched database write", buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+name_cache_lookups = Counter(registry, "ais_name_cache_lookups_total", "Vessel name cache lookups", labels=("result",))
+name_cache_hit_ratio = Gauge(registry, "ais_name_cache_hit_ratio", "Fraction of vessel name lookups served from the cache")
+queue_depth = Gauge(registry, "ais_queue_depth", "Decoded messages waiting for a writer")
+spool_bytes = Gauge(registry, "ais_spool_bytes", "Bytes held in the position spool")
+reconnects = Counter(registry, "ais_reconnects_total", "Reconnects to the AIS stream")
+
+async def write_rows(table, rows, query):
+    """Run a batched database write off the event loop and record its metrics."""
+    with db_write_seconds.time():
+        await asyncio.to_thread(query)
+    db_batch_size.observe(len(rows))
+    rows_written.inc(table, amount=len(rows))
+
+# Sharded ingestion. With AIS_SHARDS > 1 the globe is split into that many
+# longitude bands, each collected by its own process with its own websocket
+# connection. AIS_SHARD_BOXES overrides the split with an explicit JSON list of
+# aisstream.io bounding-box lists, one per shard, e.g.
+# [[[[-90, -180], [90, 0]]], [[[-90, 0], [90, 180]]]]
+WORLDWIDE = [[[-90, -180], [90, 180]]]
+AIS_SHARDS = int(os.environ.get("AIS_SHARDS", "1"))
+AIS_SHARD_BOXES = os.environ.get("AIS_SHARD_BOXES")
+SHARD_RESTART_BACKOFF = float(os.environ.get("SHARD_RESTART_BACKOFF", "5"))
+SHARD_MAX_BACKOFF = float(os.environ.get("SHARD_MAX_BACKOFF", "300"))
+
+# Batching for vessel_positions inserts: a batch is flushed as soon as it
+# reaches POSITION_BATCH_SIZE rows or POSITION_FLUSH_INTERVAL seconds have
+# passed since the last flush, whichever comes first.
+POSITION_BATCH_SIZE = int(os.environ.get("POSITION_BATCH_SIZE", "500"))
+POSITION_FLUSH_INTERVAL = float(os.environ.get("POSITION_FLUSH_INTERVAL", "2.0"))
+
+class BatchWriter:
+    """Buffer rows for a table and write them as multi-row inserts."""
+
+    def __init__(self, table, batch_size, flush_interval):
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    async def add(self, row):
+        """Queue a row, flushing immediately if the batch is full."""
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Write everything currently buffered in a single insert."""
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        try:
+            await write_rows(self.table, rows, lambda: supabase.table(self.table).insert(rows).execute())
+        except Exception as e:
+            print(f"Error inserting {len(rows)} rows into {self.table}: {e}")
+
+    async def run(self):
+        """Flush on the time threshold so quiet periods still get written."""
+        while True:
+            remaining = self.last_flush + self.flush_interval - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            else:
+                await self.flush()
+
+# Write-ahead spool for vessel_positions. Positions are appended to segment
+# files under SPOOL_DIR first and drained into the database in batches of
+# POSITION_BATCH_SIZE, so a slow or unavailable database doesn't lose data.
+# Set SPOOL_DIR to an empty string to write straight to the database.
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "spool")
+SPOOL_SEGMENT_BYTES = int(os.environ.get("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))
+SPOOL_RETRY_INTERVAL = float(os.environ.get("SPOOL_RETRY_INTERVAL", "5"))
+
+def is_permanent_error(error):
+    """Whether a database error rejects the rows themselves, so retrying can't help.
+    
+    PostgREST reports the Postgres SQLSTATE (or its own PGRSTxxx code) in the
+    error's code: data exceptions (22xxx), integrity constraint violations
+    (23xxx) and malformed requests (PGRST1xx) are permanent. Connection,
+    timeout, authentication and server errors are retried.
+    """
+    code = str(getattr(error, "code", None) or "")
+    return code[:2] in ("22", "23") or code.startswith("PGRST1")
+
+class SpoolWriter:
+    """Append rows to an on-disk spool and drain them into a table in batches."""
+
+    def __init__(self, spool, table, batch_size, flush_interval):
+        self.spool = spool
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = 0
+        self.ready = None
+        self.lock = None
+        self.in_flight = None
+
+    async def add(self, row):
+        """Spool a row, waking the drainer once a full batch is waiting."""
+        if not self.spool.append(row):
+            messages_dropped.inc("spool_full")
+            if self.spool.dropped % 1000 == 1:
+                print(f"Spool is full, {self.spool.dropped} positions dropped so far")
+            return
+        self.pending += 1
+        if self.pending >= self.batch_size and self.ready is not None:
+            self.ready.set()
+
+    async def _insert(self, rows):
+        """Insert rows, isolating and quarantining the ones the table rejects.
+        
+        A permanently rejected batch is split in halves until the offending
+        rows are found. Raises on errors worth retrying.
+        """
+        try:
+            await write_rows(self.table, rows, lambda: supabase.table(self.table).insert(rows).execute())
+        except Exception as e:
+            if not is_permanent_error(e):
+                raise
+            if len(rows) == 1:
+                print(f"Quarantining a row rejected by {self.table}: {e}")
+                messages_dropped.inc("rejected")
+                self.spool.quarantine(rows)
+                return
+            middle = len(rows) // 2
+            await self._insert(rows[:middle])
+            await self._insert(rows[middle:])
+
+    async def _drain_batch(self, rows, checkpoint):
+        """Store a batch and commit the checkpoint past it, returning False on failure."""
+        try:
+            await self._insert(rows)
+        except Exception as e:
+            print(f"Error inserting {len(rows)} spooled rows into {self.table}: {e}")
+            return False
+        self.spool.commit(checkpoint)
+        return True
+
+    async def flush(self):
+        """Drain the spool into the table, returning False if a write failed."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # A drain whose flush was cancelled keeps running until its batch
+            # is committed; wait for it so the batch isn't inserted twice
+            if self.in_flight is not None and not self.in_flight.done():
+                await asyncio.wait([self.in_flight])
+            while True:
+                rows, checkpoint = self.spool.read_batch(self.batch_size)
+                if not rows:
+                    return True
+                self.in_flight = asyncio.ensure_future(self._drain_batch(rows, checkpoint))
+                if not await asyncio.shield(self.in_flight):
+                    return False
+                if len(rows) < self.batch_size:
+                    return True
+
+    async def run(self):
+        """Drain whenever a batch is full or the flush interval has passed."""
+        self.ready = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.ready.clear()
+            self.pending = 0
+            if not await self.flush():
+                await asyncio.sleep(SPOOL_RETRY_INTERVAL)
+
+position_writer = BatchWriter("vessel_positions", POSITION_BATCH_SIZE, POSITION_FLUSH_INTERVAL)
+
+# Current state of every vessel, kept in memory and periodically upserted into
+# vessel_latest (one row per MMSI, primary key mmsi, same columns as
+# vessel_positions) so "where is everyone now" is a single indexed read.
+# Only vessels that reported since the last upsert are written.
+VESSEL_LATEST_INTERVAL = float(os.environ.get("VESSEL_LATEST_INTERVAL", "10"))
+VESSEL_LATEST_BATCH_SIZE = int(os.environ.get("VESSEL_LATEST_BATCH_SIZE", "1000"))
+
+class UpsertTracker:
+    """Per-vessel state upserted into a table keyed on mmsi, changed vessels only.
+    
+    Subclasses mark vessels in self.dirty and build their rows in row().
+    """
+
+    def __init__(self, table, interval, batch_size):
+        self.table = table
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dirty = set()
+
+    def row(self, mmsi):
+        """Return the row to upsert for a vessel."""
+        raise NotImplementedError
+
+    async def flush(self):
+        """Upsert every vessel that changed since the last flush."""
+        dirty, self.dirty = list(self.dirty), set()
+        for i in range(0, len(dirty), self.batch_size):
+            chunk = dirty[i:i + self.batch_size]
+            rows = [self.row(mmsi) for mmsi in chunk]
+            try:
+                await write_rows(
+                    self.table, rows,
+                    lambda: supabase.table(self.table).upsert(rows, on_conflict="mmsi").execute()
+                )
+            except Exception as e:
+                print(f"Error upserting {len(rows)} rows into {self.table}: {e}")
+                self.dirty.update(chunk)
+
+    async def run(self):
+        """Upsert changed vessels every interval."""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+class LatestPositionTracker(UpsertTracker):
+    """Track the latest position per vessel and upsert changed rows."""
+
+    def __init__(self, table, interval, batch_size):
+        super().__init__(table, interval, batch_size)
+        self.latest = {}  # mmsi -> vessel_data
+
+    def update(self, vessel_data):
+        """Record the newest position for a vessel."""
+        mmsi = vessel_data["mmsi"]
+        self.latest[mmsi] = vessel_data
+        self.dirty.add(mmsi)
+
+    def row(self, mmsi):
+        return self.latest[mmsi]
+
+latest_positions = LatestPositionTracker("vessel_latest", VESSEL_LATEST_INTERVAL, VESSEL_LATEST_BATCH_SIZE)
+
+# Rolling movement statistics per vessel, kept up to date as reports arrive so
+# predictions don't have to rescan a day of positions. Observations are
+# weighted by exp(-age / VESSEL_STATS_WINDOW), and the statistics of vessels
+# that reported are upserted into vessel_stats (one row per MMSI) every
+# VESSEL_STATS_INTERVAL seconds. The statistics follow analyze_movement_pattern
+# in scripts/predict_delays.py: speed mean and standard deviation, course
+# changes of more than 30 degrees, and periods below 1 knot. The speed
+# deviation is only reported once the decayed weights add up to
+# VESSEL_STATS_MIN_REPORTS effective reports, and a vessel silent for longer
+# than the window starts over from scratch.
+#
+# The statistics live only in this process: after a restart, or when a vessel
+# moves into another shard's bounding boxes, its row is rebuilt from the
+# reports seen since. report_weight says how much data a row rests on, and
+# predict_delays.py ignores rows below its own minimum. Shard boxes must not
+# overlap, or two trackers would keep overwriting the same row.
+VESSEL_STATS_WINDOW = float(os.environ.get("VESSEL_STATS_WINDOW", "86400"))
+VESSEL_STATS_INTERVAL = float(os.environ.get("VESSEL_STATS_INTERVAL", "60"))
+VESSEL_STATS_BATCH_SIZE = int(os.environ.get("VESSEL_STATS_BATCH_SIZE", "1000"))
+VESSEL_STATS_MIN_REPORTS = float(os.environ.get("VESSEL_STATS_MIN_REPORTS", "3"))
+
+class RollingStats:
+    """Exponentially decayed movement statistics for one vessel."""
+
+    __slots__ = ("weight", "weight_sq", "mean", "m2", "course_changes", "stationary_periods",
+                 "last_course", "stationary", "updated")
+
+    def __init__(self, now):
+        self.weight = 0.0
+        self.weight_sq = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.course_changes = 0.0
+        self.stationary_periods = 0.0
+        self.last_course = None
+        self.stationary = False
+        self.updated = now
+
+    def update(self, speed, course, now, window):
+        if now - self.updated > window:
+            # Silent for longer than the window: what's left is too stale to
+            # blend in, compare the course against or continue a stationary
+            # period from
+            self.__init__(now)
+        decay = math.exp(-(now - self.updated) / window)
+        self.updated = now
+        self.course_changes *= decay
+        self.stationary_periods *= decay
+        self.m2 *= decay
+        self.weight *= decay
+        self.weight_sq *= decay * decay
+
+        if speed is not None:
+            # Weighted Welford update of the speed mean and variance
+            self.weight += 1
+            self.weight_sq += 1
+            delta = speed - self.mean
+            self.mean += delta / self.weight
+            self.m2 += delta * (speed - self.mean)
+
+            if speed < STATIONARY_SPEED and not self.stationary:
+                self.stationary_periods += 1
+                self.stationary = True
+            elif speed >= STATIONARY_SPEED:
+                self.stationary = False
+
+        if course is not None and self.last_course is not None:
+            diff = abs(course - self.last_course)
+            if 30 < diff < 330:  # Handling the 0/360 boundary
+                self.course_changes += 1
+        self.last_course = course
+
+class VesselStatsTracker(UpsertTracker):
+    """Maintain rolling statistics per vessel and upsert changed rows."""
+
+    def __init__(self, table, window, interval, batch_size):
+        super().__init__(table, interval, batch_size)
+        self.window = window
+        self.stats = {}  # mmsi -> RollingStats
+
+    def update(self, mmsi, speed, course):
+        """Fold a stored position report into the vessel's statistics."""
+        now = time.time()
+        stats = self.stats.get(mmsi)
+        if stats is None:
+            stats = self.stats[mmsi] = RollingStats(now)
+        stats.update(speed, course, now, self.window)
+        self.dirty.add(mmsi)
+
+    def row(self, mmsi):
+        """Return the vessel_stats row for a vessel."""
+        stats = self.stats[mmsi]
+        variance = None
+        effective_reports = stats.weight ** 2 / stats.weight_sq if stats.weight_sq else 0
+        if round(effective_reports, 1) >= VESSEL_STATS_MIN_REPORTS:
+            # Unbiased for reliability weights: m2 / (W - sum(w^2) / W)
+            variance = stats.m2 / (stats.weight - stats.weight_sq / stats.weight)
+        return {
+            "mmsi": mmsi,
+            "avg_speed": round(stats.mean, 2) if stats.weight else None,
+            "speed_variation": round(math.sqrt(variance), 2) if variance is not None else None,
+            "course_changes": round(stats.course_changes),
+            "stationary_periods": round(stats.stationary_periods),
+            "report_weight": round(stats.weight, 2),
+            "updated_at": datetime.fromtimestamp(stats.updated, timezone.utc).isoformat()
+        }
+
+vessel_stats = VesselStatsTracker("vessel_stats", VESSEL_STATS_WINDOW, VESSEL_STATS_INTERVAL, VESSEL_STATS_BATCH_SIZE)
+
+# Vessel name cache. Names almost never change, so lookups are served from
+# memory; entries older than VESSEL_NAME_TTL are still returned but get
+# re-fetched in the background. Unknown MMSIs are cached as well, with their
+# own (shorter) TTL, so they stop generating queries.
+VESSEL_NAME_CACHE_SIZE = int(os.environ.get("VESSEL_NAME_CACHE_SIZE", "200000"))
+VESSEL_NAME_TTL = float(os.environ.get("VESSEL_NAME_TTL", "86400"))
+VESSEL_NAME_NEGATIVE_TTL = float(os.environ.get("VESSEL_NAME_NEGATIVE_TTL", "3600"))
+VESSEL_NAME_REFRESH_INTERVAL = float(os.environ.get("VESSEL_NAME_REFRESH_INTERVAL", "60"))
+VESSEL_NAME_REFRESH_BATCH = int(os.environ.get("VESSEL_NAME_REFRESH_BATCH", "200"))
+# Bulk selects are paged, since PostgREST caps the rows a single request returns
+SELECT_PAGE_SIZE = 1000
+
+class VesselNameCache:
+    """LRU cache of MMSI -> vessel name with TTL and negative caching."""
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # mmsi -> (vessel_name, fetched_at)
+        self.stale = set()
+
+    def _store(self, mmsi, vessel_name):
+        self.entries[mmsi] = (vessel_name, time.monotonic())
+        self.entries.move_to_end(mmsi)
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            self.stale.discard(evicted)
+
+    async def get(self, mmsi):
+        """Return the cached name for an MMSI, fetching it on a cold miss."""
+        entry = self.entries.get(mmsi)
+        if entry is not None:
+            name_cache_lookups.inc("hit")
+            self.entries.move_to_end(mmsi)
+            vessel_name, fetched_at = entry
+            ttl = self.ttl if vessel_name else self.negative_ttl
+            if time.monotonic() - fetched_at > ttl:
+                self.stale.add(mmsi)
+            return vessel_name
+
+        name_cache_lookups.inc("miss")
+        response = await asyncio.to_thread(
+            lambda: supabase.table("vessel_metadata").select("vessel_name").eq("mmsi", mmsi).execute()
+        )
+        vessel_name = None
+        if response.data and response.data[0].get("vessel_name"):
+            vessel_name = response.data[0].get("vessel_name")
+        self._store(mmsi, vessel_name)
+        return vessel_name
+
+    async def warm_up(self):
+        """Load known vessel names with a paged bulk select."""
+        try:
+            offset = 0
+            while offset < self.max_size:
+                end = min(offset + SELECT_PAGE_SIZE, self.max_size) - 1
+                response = await asyncio.to_thread(
+                    lambda: supabase.table("vessel_metadata")
+                        .select("mmsi", "vessel_name")
+                        .order("mmsi", desc=False)
+                        .range(offset, end)
+                        .execute()
+                )
+                for row in response.data:
+                    self._store(row.get("mmsi"), row.get("vessel_name") or None)
+                if len(response.data) < end - offset + 1:
+                    break
+                offset = end + 1
+            print(f"Vessel name cache warmed up with {len(self.entries)} entries")
+        except Exception as e:
+            print(f"Error warming up vessel name cache: {e}")
+
+    async def refresh_stale(self):
+        """Re-fetch stale entries in batches using an `in` filter."""
+        stale, self.stale = list(self.stale), set()
+        for i in range(0, len(stale), VESSEL_NAME_REFRESH_BATCH):
+            chunk = stale[i:i + VESSEL_NAME_REFRESH_BATCH]
+            try:
+                response = await asyncio.to_thread(
+                    lambda: supabase.table("vessel_metadata")
+                        .select("mmsi", "vessel_name")
+                        .in_("mmsi", chunk)
+                        .execute()
+                )
+            except Exception as e:
+                print(f"Error refreshing vessel names: {e}")
+                self.stale.update(chunk)
+                continue
+
+            found = {row.get("mmsi"): row.get("vessel_name") or None for row in response.data}
+            for mmsi in chunk:
+                if mmsi in self.entries:
+                    self._store(mmsi, found.get(mmsi))
+
+    async def run(self):
+        """Periodically refresh stale entries in the background."""
+        while True:
+            await asyncio.sleep(VESSEL_NAME_REFRESH_INTERVAL)
+            await self.refresh_stale()
+
+vessel_names = VesselNameCache(VESSEL_NAME_CACHE_SIZE, VESSEL_NAME_TTL, VESSEL_NAME_NEGATIVE_TTL)
+
+def _name_cache_hit_ratio():
+    lookups = name_cache_lookups.get("hit") + name_cache_lookups.get("miss")
+    return name_cache_lookups.get("hit") / lookups if lookups else 0
+
+name_cache_hit_ratio.function = _name_cache_hit_ratio
+
+# Movement-aware deduplication. A report is only stored if the vessel moved
+# more than DEDUP_MIN_DISTANCE_M metres, its speed or course changed by more
+# than the given deltas, it crossed the 1 knot stationary threshold used by
+# the movement analysis, or DEDUP_MAX_SILENCE seconds passed since the last
+# stored report for that vessel.
+DEDUP_MIN_DISTANCE_M = float(os.environ.get("DEDUP_MIN_DISTANCE_M", "50"))
+DEDUP_SPEED_DELTA = float(os.environ.get("DEDUP_SPEED_DELTA", "0.5"))
+DEDUP_COURSE_DELTA = float(os.environ.get("DEDUP_COURSE_DELTA", "10"))
+DEDUP_MAX_SILENCE = float(os.environ.get("DEDUP_MAX_SILENCE", "300"))
+STATIONARY_SPEED = 1.0
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in metres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+class PositionFilter:
+    """Per-MMSI filter that drops reports which add nothing to the track."""
+
+    def __init__(self, min_distance_m, speed_delta, course_delta, max_silence):
+        self.min_distance_m = min_distance_m
+        self.speed_delta = speed_delta
+        self.course_delta = course_delta
+        self.max_silence = max_silence
+        self.last_kept = {}  # mmsi -> (lat, lon, speed, course, kept_at)
+        self.kept = 0
+        self.suppressed = 0
+
+    def _changed(self, previous, lat, lon, speed, course, now):
+        prev_lat, prev_lon, prev_speed, prev_course, kept_at = previous
+        if now - kept_at >= self.max_silence:
+            return True
+        if None in (lat, lon, prev_lat, prev_lon):
+            return (lat, lon) != (prev_lat, prev_lon)
+        if haversine_m(prev_lat, prev_lon, lat, lon) > self.min_distance_m:
+            return True
+        if speed is not None and prev_speed is not None:
+            if abs(speed - prev_speed) > self.speed_delta:
+                return True
+            if (speed < STATIONARY_SPEED) != (prev_speed < STATIONARY_SPEED):
+                return True
+        elif speed != prev_speed:
+            return True
+        if course is not None and prev_course is not None:
+            diff = abs(course - prev_course) % 360
+            if min(diff, 360 - diff) > self.course_delta:
+                return True
+        return False
+
+    def should_keep(self, mmsi, lat, lon, speed, course):
+        """Return True if the report should be stored, recording it if so."""
+        now = time.monotonic()
+        previous = self.last_kept.get(mmsi)
+        if previous is not None and not self._changed(previous, lat, lon, speed, course, now):
+            self.suppressed += 1
+            return False
+        self.last_kept[mmsi] = (lat, lon, speed, course, now)
+        self.kept += 1
+        return True
+
+position_filter = PositionFilter(DEDUP_MIN_DISTANCE_M, DEDUP_SPEED_DELTA, DEDUP_COURSE_DELTA, DEDUP_MAX_SILENCE)
+
+# Delay prediction triggers are coalesced per vessel. While a vessel has a
+# pending prediction_queue job, new triggers update that job's position; once
+# it has been processed, a new job is only queued after PREDICTION_COOLDOWN
+# seconds have passed since the previous one.
+PREDICTION_COOLDOWN = float(os.environ.get("PREDICTION_COOLDOWN", "3600"))
+
+pending_predictions = {}  # mmsi -> id of the pending prediction_queue row
+last_prediction_trigger = {}  # mmsi -> time the last job was queued
+triggers_in_flight = set()
+
+# Pipeline between the websocket reader and the database writers. When the
+# queue is full the overflow policy decides what happens to a new message:
+#   drop_oldest - discard the oldest queued message to make room (default)
+#   drop_newest - discard the incoming message
+#   block       - wait for space, applying backpressure to the websocket
+MESSAGE_QUEUE_SIZE = int(os.environ.get("MESSAGE_QUEUE_SIZE", "10000"))
+QUEUE_OVERFLOW_POLICY = os.environ.get("QUEUE_OVERFLOW_POLICY", "drop_oldest")
+WRITER_WORKERS = int(os.environ.get("WRITER_WORKERS", "4"))
+
+async def enqueue_message(queue, message):
+    """Put a decoded report on the queue, applying the overflow policy."""
+    if QUEUE_OVERFLOW_POLICY == "block":
+        await queue.put(message)
+        return
+
+    if queue.full():
+        messages_dropped.inc("queue_full")
+        dropped = messages_dropped.get("queue_full")
+        if dropped % 1000 == 1:
+            print(f"Message queue full, {dropped} messages dropped so far ({QUEUE_OVERFLOW_POLICY})")
+        if QUEUE_OVERFLOW_POLICY == "drop_newest":
+            return
+        queue.get_nowait()
+        queue.task_done()
+
+    queue.put_nowait(message)
+
+async def position_worker(queue):
+    """Take position reports off the queue and hand them to the database layer."""
     while True:
+        report = await queue.get()
         try:
-            async with websockets.connect("wss://stream.aisstream.io/v0/stream") as websocket:
-                print(f"[{datetime.now(timezone.utc)}] Connected to AIS Stream")
+            await process_position_report(report)
+        finally:
+            queue.task_done()
+
+async def connect_ais_stream(queue, bounding_boxes=WORLDWIDE):
+    """Connect to the AIS Stream WebSocket and queue vessel position reports."""
+    while True:
+        try:
+            async with websockets.connect(AIS_STREAM_URL) as websocket:
+                print(f"[{datetime.now(timezone.utc)}] Connected to AIS Stream ({'msgspec' if FAST_DECODE else 'json'} decoding)")
                 
-                # Subscribe to global shipping data
-                # We're not filtering by specific vessels, so we get worldwide data
+                # Subscribe to shipping data in our bounding boxes
+                # (worldwide unless this process is one shard of several)
+                # We're not filtering by specific vessels
                 subscribe_message = {
                     "APIKey": AIS_API_KEY,
-                    "BoundingBoxes": [[[-90, -180], [90, 180]]],  # Worldwide coverage
+                    "BoundingBoxes": bounding_boxes,
                     "FilterMessageTypes": ["PositionReport"]
                 }
                 
@@ -33,37 +622,48 @@ async def connect_ais_stream():
                 
                 # Process messages as they arrive
                 async for message_json in websocket:
+                    messages_received.inc()
                     try:
-                        message = json.loads(message_json)
-                        message_type = message.get("MessageType")
+                        report = decode_position_report(message_json)
                         
-                        if message_type == "PositionReport":
-                            await process_position_report(message)
+                        if report is not None:
+                            messages_decoded.inc()
+                            await enqueue_message(queue, report)
                             
                     except Exception as e:
+                        messages_dropped.inc("decode_error")
                         print(f"Error processing message: {e}")
+            
+            # The server closed the connection cleanly
+            print("WebSocket connection closed by the server")
         
         except Exception as e:
             print(f"WebSocket connection error: {e}")
-            print("Reconnecting in 5 seconds...")
-            await asyncio.sleep(5)
+        
+        reconnects.inc()
+        print("Reconnecting in 5 seconds...")
+        await asyncio.sleep(5)
 
-async def process_position_report(message):
-    """Process an AIS position report and store it in the database."""
+async def process_position_report(report):
+    """Process a decoded AIS position report and store it in the database."""
     try:
-        ais_message = message['Message']['PositionReport']
-        
         # Extract vessel data
-        mmsi = ais_message.get('UserID')
+        mmsi = report["mmsi"]
+        latitude = report["lat"]
+        longitude = report["lon"]
+        speed = report["speed"]
+        course = report["course"]
+        timestamp = report["timestamp"]
+        
+        # Skip reports from vessels that haven't meaningfully moved
+        if not position_filter.should_keep(mmsi, latitude, longitude, speed, course):
+            positions_suppressed.inc()
+            return
+        
         vessel_name = await get_vessel_name(mmsi)
-        latitude = ais_message.get('Latitude')
-        longitude = ais_message.get('Longitude')
-        speed = ais_message.get('SOG')  # Speed Over Ground
-        course = ais_message.get('COG')  # Course Over Ground
-        timestamp = datetime.now(timezone.utc).isoformat()
         
-        # Print for logging
-        print(f"[{timestamp}] Vessel: {vessel_name or mmsi} Position: {latitude}, {longitude} Speed: {speed} Course: {course}")
+        # Log a sample of positions rather than every report
+        log_position(f"[{timestamp}] Vessel: {vessel_name or mmsi} Position: {latitude}, {longitude} Speed: {speed} Course: {course}")
         
         # Store in database
         vessel_data = {
@@ -76,48 +676,242 @@ async def process_position_report(message):
             "timestamp": timestamp
         }
         
-        response = supabase.table("vessel_positions").insert(vessel_data).execute()
+        await position_writer.add(vessel_data)
+        latest_positions.update(vessel_data)
+        vessel_stats.update(mmsi, speed, course)
         
         # Check if we need to make a delay prediction
         if speed and speed < 3.0:  # Potential delay if ship is moving slowly
             await trigger_delay_prediction(vessel_data)
     
     except Exception as e:
+        messages_dropped.inc("error")
         print(f"Error processing position report: {e}")
 
+last_position_log = 0.0
+
+def log_position(line):
+    """Print a position line at most once every POSITION_LOG_INTERVAL seconds."""
+    global last_position_log
+    now = time.monotonic()
+    if now - last_position_log < POSITION_LOG_INTERVAL:
+        return
+    last_position_log = now
+    print(f"{line} (received {messages_received.get()}, decoded {messages_decoded.get()}, "
+          f"suppressed {positions_suppressed.get()}, written {rows_written.get('vessel_positions')})")
+
 async def get_vessel_name(mmsi):
     """Get vessel name from MMSI number (using existing database or external API)."""
     try:
-        # Check if we already have the vessel name in our database
-        response = supabase.table("vessel_metadata").select("vessel_name").eq("mmsi", mmsi).execute()
-        
-        if response.data and response.data[0].get("vessel_name"):
-            return response.data[0].get("vessel_name")
-        
-        # If not, we could query an external API for vessel info
-        # For now, return None and let the system use MMSI as identifier
-        return None
+        # Served from the in-process cache; unknown vessels are cached as None
+        # and the system uses the MMSI as identifier
+        return await vessel_names.get(mmsi)
     
     except Exception as e:
         print(f"Error getting vessel name: {e}")
         return None
 
+async def load_pending_predictions():
+    """Seed the coalescing map with jobs that are already pending."""
+    try:
+        offset = 0
+        now = time.monotonic()
+        while True:
+            response = await asyncio.to_thread(
+                lambda: supabase.table("prediction_queue")
+                    .select("id", "mmsi")
+                    .eq("status", "pending")
+                    .order("id", desc=False)
+                    .range(offset, offset + SELECT_PAGE_SIZE - 1)
+                    .execute()
+            )
+            for row in response.data:
+                pending_predictions[row["mmsi"]] = row["id"]
+                last_prediction_trigger[row["mmsi"]] = now
+            if len(response.data) < SELECT_PAGE_SIZE:
+                break
+            offset += SELECT_PAGE_SIZE
+        print(f"Loaded {len(pending_predictions)} pending prediction jobs")
+    except Exception as e:
+        print(f"Error loading pending predictions: {e}")
+
 async def trigger_delay_prediction(vessel_data):
     """Trigger a delay prediction for a vessel that appears to be delayed."""
+    mmsi = vessel_data["mmsi"]
+    if mmsi in triggers_in_flight:
+        return
+    triggers_in_flight.add(mmsi)
     try:
+        # If the vessel already has a pending job, refresh its position instead
+        # of queueing another one
+        job_id = pending_predictions.get(mmsi)
+        if job_id is not None:
+            response = await asyncio.to_thread(
+                lambda: supabase.table("prediction_queue")
+                    .update({
+                        "vessel_name": vessel_data["vessel_name"],
+                        "position_data": json.dumps(vessel_data)
+                    })
+                    .eq("id", job_id)
+                    .eq("status", "pending")
+                    .execute()
+            )
+            if response.data:
+                return
+            # The job has been picked up since we queued it
+            del pending_predictions[mmsi]
+        
+        last_trigger = last_prediction_trigger.get(mmsi)
+        if last_trigger is not None and time.monotonic() - last_trigger < PREDICTION_COOLDOWN:
+            return
+        
         # Add to prediction queue
         queue_data = {
-            "mmsi": vessel_data["mmsi"],
+            "mmsi": mmsi,
             "vessel_name": vessel_data["vessel_name"],
             "position_data": json.dumps(vessel_data),
             "status": "pending",
             "created_at": datetime.now(timezone.utc).isoformat()
         }
         
-        supabase.table("prediction_queue").insert(queue_data).execute()
+        response = await asyncio.to_thread(lambda: supabase.table("prediction_queue").insert(queue_data).execute())
+        last_prediction_trigger[mmsi] = time.monotonic()
+        if response.data:
+            pending_predictions[mmsi] = response.data[0]["id"]
         
     except Exception as e:
         print(f"Error triggering delay prediction: {e}")
+    finally:
+        triggers_in_flight.discard(mmsi)
+
+async def main(bounding_boxes=WORLDWIDE, spool_dir=SPOOL_DIR, metrics_port=METRICS_PORT):
+    """Run the collector and flush any buffered positions on shutdown."""
+    global position_writer
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    
+    def shut_down():
+        # Only the first signal cancels: a second one (e.g. Ctrl-C reaching a
+        # shard directly and then the supervisor's terminate()) would
+        # otherwise cancel the flushes in the finally block below
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, print, "Already shutting down, ignoring signal")
+        main_task.cancel()
+    
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shut_down)
+
+    spool = None
+    if spool_dir:
+        spool = Spool(spool_dir, SPOOL_SEGMENT_BYTES, SPOOL_MAX_BYTES)
+        spool.open()
+        position_writer = SpoolWriter(spool, "vessel_positions", POSITION_BATCH_SIZE, POSITION_FLUSH_INTERVAL)
+        spool_bytes.function = spool.total_bytes
+        print(f"Spooling positions to {spool_dir} ({spool.total_bytes()} bytes waiting)")
+    
+    queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+    queue_depth.function = queue.qsize
+    if metrics_port:
+        await serve_metrics(registry, METRICS_HOST, metrics_port)
+        print(f"Serving metrics on http://{METRICS_HOST}:{metrics_port}/metrics")
+    workers = [asyncio.create_task(position_worker(queue)) for _ in range(WRITER_WORKERS)]
+    await vessel_names.warm_up()
+    await load_pending_predictions()
+    flush_task = asyncio.create_task(position_writer.run())
+    refresh_task = asyncio.create_task(vessel_names.run())
+    latest_task = asyncio.create_task(latest_positions.run())
+    stats_task = asyncio.create_task(vessel_stats.run())
+    try:
+        await connect_ais_stream(queue, bounding_boxes)
+    except asyncio.CancelledError:
+        print("Shutting down, flushing buffered positions...")
+    finally:
+        try:
+            await asyncio.wait_for(queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            print(f"Timed out draining message queue, {queue.qsize()} messages left unprocessed")
+        for task in workers + [flush_task, refresh_task, latest_task, stats_task]:
+            task.cancel()
+        await position_writer.flush()
+        await latest_positions.flush()
+        await vessel_stats.flush()
+        if spool is not None:
+            spool.close()
+        print(f"Position filter kept {position_filter.kept} reports, suppressed {position_filter.suppressed}")
+
+def shard_bounding_boxes():
+    """Return the list of bounding boxes each shard subscribes to."""
+    if AIS_SHARD_BOXES:
+        return json.loads(AIS_SHARD_BOXES)
+    
+    width = 360 / AIS_SHARDS
+    return [
+        [[[-90, -180 + i * width], [90, -180 + (i + 1) * width]]]
+        for i in range(AIS_SHARDS)
+    ]
+
+def run_shard(index, bounding_boxes):
+    """Entry point of a shard worker process."""
+    spool_dir = os.path.join(SPOOL_DIR, f"shard-{index}") if SPOOL_DIR else ""
+    metrics_port = METRICS_PORT + index if METRICS_PORT else 0
+    asyncio.run(main(bounding_boxes, spool_dir, metrics_port))
+
+def supervise_shards(shards):
+    """Run one collector process per shard, restarting failed ones with backoff."""
+    ctx = multiprocessing.get_context("spawn")
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    
+    processes = [None] * len(shards)
+    started_at = [0.0] * len(shards)
+    failures = [0] * len(shards)
+    restart_at = [0.0] * len(shards)
+    
+    while not stopping:
+        now = time.monotonic()
+        for i, boxes in enumerate(shards):
+            process = processes[i]
+            if process is not None and process.is_alive():
+                continue
+            
+            if process is not None:
+                # A shard that ran for a while before dying starts its backoff over
+                if now - started_at[i] > SHARD_MAX_BACKOFF:
+                    failures[i] = 0
+                failures[i] += 1
+                delay = min(SHARD_MAX_BACKOFF, SHARD_RESTART_BACKOFF * 2 ** (failures[i] - 1))
+                print(f"Shard {i} exited with code {process.exitcode}, restarting in {delay:.0f} seconds")
+                processes[i] = None
+                restart_at[i] = now + delay
+            
+            if now >= restart_at[i]:
+                print(f"Starting shard {i} for {boxes}")
+                processes[i] = ctx.Process(target=run_shard, args=(i, boxes), name=f"ais-shard-{i}")
+                processes[i].start()
+                started_at[i] = now
+        time.sleep(1)
+    
+    print("Stopping shards...")
+    for process in processes:
+        if process is not None and process.is_alive():
+            process.terminate()
+    for process in processes:
+        if process is not None:
+            process.join(timeout=30)
+            if process.is_alive():
+                print(f"{process.name} did not stop in time, killing it")
+                process.kill()
+                process.join()
 
 if __name__ == "__main__":
-    asyncio.run(connect_ais_stream())
+    shards = shard_bounding_boxes()
+    if len(shards) > 1:
+        supervise_shards(shards)
+    else:
+        asyncio.run(main(shards[0]))
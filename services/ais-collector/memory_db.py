@@ -0,0 +1,166 @@
+"""In-memory stand-in for the parts of the Supabase table API the collector uses.
+
+create_client() returns a client whose table(name) queries support select,
+insert, upsert, update and delete with the eq/neq/gt/gte/lt/lte/in_ filters,
+order, limit and range. Every execute() is counted per table and operation,
+and an optional latency is slept on each call to simulate a remote database.
+It is used by bench_collector.py to run the collector offline.
+"""
+import itertools
+import threading
+import time
+from collections import Counter
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+class Query:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.operation = "select"
+        self.columns = None
+        self.payload = None
+        self.on_conflict = None
+        self.filters = []
+        self.ordering = None
+        self.row_limit = None
+        self.row_offset = 0
+
+    def select(self, *columns):
+        self.operation = "select"
+        self.columns = [c for column in columns for c in column.split(",") if c != "*"] or None
+        return self
+
+    def insert(self, rows):
+        self.operation, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict="id"):
+        self.operation, self.payload, self.on_conflict = "upsert", rows, on_conflict
+        return self
+
+    def update(self, values):
+        self.operation, self.payload = "update", values
+        return self
+
+    def delete(self):
+        self.operation = "delete"
+        return self
+
+    def _filter(self, column, test):
+        self.filters.append(lambda row: row.get(column) is not None and test(row.get(column)))
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def neq(self, column, value):
+        self.filters.append(lambda row: row.get(column) != value)
+        return self
+
+    def gt(self, column, value):
+        return self._filter(column, lambda v: v > value)
+
+    def gte(self, column, value):
+        return self._filter(column, lambda v: v >= value)
+
+    def lt(self, column, value):
+        return self._filter(column, lambda v: v < value)
+
+    def lte(self, column, value):
+        return self._filter(column, lambda v: v <= value)
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.ordering = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def range(self, start, end):
+        self.row_offset, self.row_limit = start, end - start + 1
+        return self
+
+    def _matches(self, row):
+        return all(test(row) for test in self.filters)
+
+    def execute(self):
+        return self.client._execute(self)
+
+class InMemoryClient:
+    """Thread-safe in-memory tables with per-call accounting."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.calls = Counter()  # (table, operation) -> execute() calls
+        self.write_log = []  # (table, wall time, rows) for every insert/upsert
+        self.indexes = {}  # (table, column) -> {value: row} for upsert conflicts
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def table(self, name):
+        return Query(self, name)
+
+    def _index(self, table, column):
+        if (table, column) not in self.indexes:
+            self.indexes[(table, column)] = {row.get(column): row for row in self.tables.get(table, [])}
+        return self.indexes[(table, column)]
+
+    def _execute(self, query):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[(query.table, query.operation)] += 1
+            rows = self.tables.setdefault(query.table, [])
+
+            if query.operation in ("insert", "upsert"):
+                payload = query.payload if isinstance(query.payload, list) else [query.payload]
+                written = []
+                for values in payload:
+                    row = dict(values)
+                    row.setdefault("id", next(self.ids))
+                    if query.operation == "upsert":
+                        index = self._index(query.table, query.on_conflict)
+                        existing = index.get(row.get(query.on_conflict))
+                        if existing is not None:
+                            existing.update(values)
+                            written.append(existing)
+                            continue
+                        index[row.get(query.on_conflict)] = row
+                    rows.append(row)
+                    written.append(row)
+                self.write_log.append((query.table, time.time(), written))
+                return Response([dict(row) for row in written])
+
+            matched = [row for row in rows if query._matches(row)]
+            if query.operation == "update":
+                for row in matched:
+                    row.update(query.payload)
+            elif query.operation == "delete":
+                self.tables[query.table] = [row for row in rows if not query._matches(row)]
+                for table, column in list(self.indexes):
+                    if table == query.table:
+                        del self.indexes[(table, column)]
+            else:
+                if query.ordering:
+                    column, desc = query.ordering
+                    matched.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+                if query.row_limit is not None:
+                    matched = matched[query.row_offset:query.row_offset + query.row_limit]
+                if query.columns:
+                    return Response([{c: row.get(c) for c in query.columns} for row in matched])
+            return Response([dict(row) for row in matched])
+
+def create_client(url=None, key=None, latency=0.0):
+    """Return an in-memory client; url and key are accepted and ignored."""
+    return InMemoryClient(latency)
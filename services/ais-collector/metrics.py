@@ -0,0 +1,155 @@
+"""Minimal in-process metrics served in the Prometheus text format.
+
+Counters, gauges and histograms register themselves with a Registry, which
+serve() exposes over plain HTTP on /metrics. Only the standard library is
+used, so the collector has no extra dependencies.
+"""
+import asyncio
+import bisect
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names, values):
+    pairs = list(zip(names, values))
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+class Counter:
+    """Monotonically increasing value, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, registry, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+class Gauge:
+    """Point-in-time value, either set directly or read from a callback."""
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+        registry.register(self)
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [f"{self.name} {value}"]
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        registry.register(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """Context manager observing the wall time of its block."""
+        return _Timer(self)
+
+    def samples(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+async def serve(registry, host, port):
+    """Serve the registry on http://host:port/metrics."""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Consume the headers; the request body is never used
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[1].split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except Exception as e:
+            print(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
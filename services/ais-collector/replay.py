@@ -0,0 +1,114 @@
+"""Record the AIS stream to a file and replay it from a local websocket server.
+
+Usage:
+    python replay.py record recording.jsonl.gz [--seconds 600] [--max-frames N]
+    python replay.py replay recording.jsonl.gz [--speed 1|N|max] [--port 8765]
+
+Recordings are gzip-compressed JSON lines of {"t": seconds since the start of
+the recording, "frame": raw frame}. The replay server accepts the collector's
+subscription message, then sends the recorded frames with their original
+spacing divided by --speed (or as fast as possible with --speed max), and
+closes the connection. Each frame's MetaData time_utc is rewritten to the send
+time so downstream latency can be measured from the stored rows.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import re
+import time
+from datetime import datetime, timezone
+
+import websockets
+
+AIS_STREAM_URL = "wss://stream.aisstream.io/v0/stream"
+AIS_API_KEY = os.environ.get("AIS_API_KEY", "your_ais_stream_api_key")
+TIME_UTC = re.compile(r'"time_utc"\s*:\s*"[^"]*"')
+
+async def record(path, seconds, max_frames, bounding_boxes):
+    """Capture raw frames from aisstream.io into a compressed recording."""
+    frames = 0
+    async with websockets.connect(AIS_STREAM_URL) as websocket:
+        await websocket.send(json.dumps({
+            "APIKey": AIS_API_KEY,
+            "BoundingBoxes": bounding_boxes,
+            "FilterMessageTypes": ["PositionReport"]
+        }))
+        start = time.monotonic()
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            async for frame in websocket:
+                elapsed = time.monotonic() - start
+                if isinstance(frame, bytes):
+                    frame = frame.decode("utf-8")
+                f.write(json.dumps({"t": round(elapsed, 6), "frame": frame}) + "\n")
+                frames += 1
+                if elapsed >= seconds or (max_frames and frames >= max_frames):
+                    break
+    print(f"Recorded {frames} frames to {path}")
+
+def load_recording(path):
+    """Return the (offset, frame) pairs of a recording."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [(entry["t"], entry["frame"]) for entry in map(json.loads, f)]
+
+def stamp(frame):
+    """Set the frame's MetaData time_utc to now, in aisstream's format."""
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f +0000 UTC")
+    return TIME_UTC.sub(f'"time_utc":"{now}"', frame, count=1)
+
+async def serve_replay(frames, port, speed, connections=1, ready=None):
+    """Serve the recording to the next `connections` clients, then return."""
+    done = asyncio.Event()
+    served = 0
+
+    async def handler(websocket, path=None):
+        nonlocal served
+        await websocket.recv()  # subscription message
+        start = time.monotonic()
+        for offset, frame in frames:
+            if speed:
+                delay = start + offset / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await websocket.send(stamp(frame))
+        await websocket.close()
+        served += 1
+        if served >= connections:
+            done.set()
+
+    async with websockets.serve(handler, "127.0.0.1", port, max_queue=None):
+        if ready is not None:
+            ready.set()
+        print(f"Replaying {len(frames)} frames on ws://127.0.0.1:{port} at {'max' if not speed else f'{speed}x'} speed")
+        await done.wait()
+
+def parse_speed(value):
+    """Parse --speed: a multiplier, or "max" (returned as 0) for no pacing."""
+    return 0 if value == "max" else float(value)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="capture the live stream")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--seconds", type=float, default=600)
+    record_parser.add_argument("--max-frames", type=int, default=0)
+    record_parser.add_argument("--boxes", default='[[[-90, -180], [90, 180]]]',
+                               help="JSON list of bounding boxes to subscribe to")
+
+    replay_parser = commands.add_parser("replay", help="serve a recording locally")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--speed", type=parse_speed, default=1.0)
+    replay_parser.add_argument("--port", type=int, default=8765)
+    replay_parser.add_argument("--connections", type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == "record":
+        asyncio.run(record(args.path, args.seconds, args.max_frames, json.loads(args.boxes)))
+    else:
+        asyncio.run(serve_replay(load_recording(args.path), args.port, args.speed, args.connections))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Append-only on-disk spool for records waiting to be written to the database.
+
+Records are appended as JSON lines to segment files named <sequence>.log in the
+spool directory. A new segment is started once the current one reaches
+segment_size bytes. Consumers read batches from the last checkpoint and commit
+a new checkpoint once the batch is safely stored; fully consumed segments are
+then deleted. The checkpoint survives restarts, so a restarted collector
+resumes where it left off. Once the spool holds max_bytes, new records are
+dropped until the drainer catches up. Records the database rejects for good
+are set aside in quarantine.jsonl for inspection instead of blocking the
+spool.
+"""
+import json
+import os
+
+CHECKPOINT_FILE = "checkpoint.json"
+QUARANTINE_FILE = "quarantine.jsonl"
+
+class Spool:
+    """Segmented write-ahead log of JSON records with a consumer checkpoint."""
+
+    def __init__(self, directory, segment_size, max_bytes):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.segments = []  # sequence numbers of segments on disk, oldest first
+        self.sizes = {}  # sequence -> bytes written
+        self.checkpoint = (0, 0)  # (segment sequence, byte offset)
+        self.file = None
+        self.appended = 0
+        self.dropped = 0
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:012d}.log")
+
+    def open(self):
+        """Load existing segments and the checkpoint, and start a new segment."""
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".log"):
+                sequence = int(name[:-4])
+                self.segments.append(sequence)
+                self.sizes[sequence] = os.path.getsize(self._path(sequence))
+
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                checkpoint = json.load(f)
+            self.checkpoint = (checkpoint["segment"], checkpoint["offset"])
+        except (OSError, ValueError, KeyError):
+            self.checkpoint = (self.segments[0], 0) if self.segments else (0, 0)
+
+        # Never append to a segment from a previous run: it may end in a
+        # partially written line
+        self._start_segment(self.segments[-1] + 1 if self.segments else 0)
+
+    def _start_segment(self, sequence):
+        if self.file is not None:
+            self.file.close()
+        self.segments.append(sequence)
+        self.sizes[sequence] = 0
+        self.file = open(self._path(sequence), "a", encoding="utf-8")
+
+    def total_bytes(self):
+        """Bytes currently held on disk."""
+        return sum(self.sizes.values())
+
+    def append(self, record):
+        """Append a record, returning False if the spool is full."""
+        if self.total_bytes() >= self.max_bytes:
+            self.dropped += 1
+            return False
+
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        self.file.write(line)
+        current = self.segments[-1]
+        self.sizes[current] += len(line.encode("utf-8"))
+        self.appended += 1
+        if self.sizes[current] >= self.segment_size:
+            self._start_segment(current + 1)
+        return True
+
+    def read_batch(self, max_records):
+        """Read up to max_records from the checkpoint.
+
+        Returns the records and the checkpoint to commit once they are stored.
+        """
+        self.file.flush()
+        records = []
+        sequence, offset = self.checkpoint
+        for segment in self.segments:
+            if segment < sequence:
+                continue
+            if segment > sequence:
+                sequence, offset = segment, 0
+            with open(self._path(segment), "rb") as f:
+                f.seek(offset)
+                while len(records) < max_records:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Skip lines torn by a crash mid-write
+                        continue
+            if len(records) >= max_records:
+                break
+        return records, (sequence, offset)
+
+    def commit(self, checkpoint):
+        """Persist the checkpoint and delete segments that are fully consumed."""
+        self.checkpoint = checkpoint
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segment": checkpoint[0], "offset": checkpoint[1]}, f)
+        os.replace(path + ".tmp", path)
+
+        while self.segments and self.segments[0] < checkpoint[0]:
+            sequence = self.segments.pop(0)
+            del self.sizes[sequence]
+            try:
+                os.remove(self._path(sequence))
+            except OSError as e:
+                print(f"Error removing spool segment {sequence}: {e}")
+
+    def quarantine(self, records):
+        """Append records that can never be stored to the quarantine file."""
+        with open(os.path.join(self.directory, QUARANTINE_FILE), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def close(self):
+        """Flush and close the current segment."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None